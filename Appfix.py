@@ -14,6 +14,9 @@ import re
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 import tempfile
+import hashlib
+import io
+import contextlib
 
 # Configure logging with INFO level
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -39,16 +42,27 @@ azure_blob_connection_string = ("DefaultEndpointsProtocol=https;"
                                   "AccountKey=wJh4mvSgbEOoOFfcDsLVX7GSIzw59gkJF0Do77rOmOv60EFCODcNvNTaHVusWcVrvnLtkK3x4wX5+AStWjV9Ew=="
                                   "EndpointSuffix=core.windows.net")
 azure_blob_container_name = "input"
-blob_service_client = BlobServiceClient.from_connection_string(azure_blob_connection_string)
+# Blob downloads are streamed in chunks of DOWNLOAD_CHUNK_BYTES (the first ranged GET included);
+# PDFs up to DOWNLOAD_SPOOL_MAX_BYTES are buffered in memory, larger ones in a temporary file
+DOWNLOAD_CHUNK_BYTES = 4 * 1024 * 1024
+DOWNLOAD_SPOOL_MAX_BYTES = 32 * 1024 * 1024
+blob_service_client = BlobServiceClient.from_connection_string(azure_blob_connection_string,
+                                                               max_single_get_size=DOWNLOAD_CHUNK_BYTES,
+                                                               max_chunk_get_size=DOWNLOAD_CHUNK_BYTES)
 container_client = blob_service_client.get_container_client(azure_blob_container_name)
 
 # Form Recognizer configuration (replace with your actual key if available)
 form_recognizer_endpoint = "https://documentanalysisclient.cognitiveservices.azure.com/"
 form_recognizer_key = "YOUR_FORM_RECOGNIZER_KEY"  # Replace with your actual Form Recognizer key
 
-# Local directory to store downloaded PDFs
-PDF_DOWNLOAD_PATH = "downloaded_pdfs"
-os.makedirs(PDF_DOWNLOAD_PATH, exist_ok=True)
+# Optional content-addressed blob cache: PDFs are stored once per SHA-256 under this directory
+# and looked up by blob name and ETag, so unchanged blobs are never downloaded twice.
+# None disables it.
+BLOB_CACHE_PATH = None
+
+# Minimum number of letters and digits a page's embedded text layer needs to be used as is;
+# pages below it (scans, image-only pages) are sent to Form Recognizer
+LOCAL_TEXT_MIN_CHARS = 50
 
 # ---------------------
 # Database Initialization Functions
@@ -91,56 +105,199 @@ def init_pdf_cache_db():
                 content TEXT NOT NULL
             )
         ''')
+        # Citation fields computed once at ingest so search_pdfs_helper never re-parses file names
+        existing = {row[1] for row in c.execute("PRAGMA table_info(pdf_texts)").fetchall()}
+        for column, declaration in [("citation", "TEXT"), ("author", "TEXT"), ("year", "INTEGER"),
+                                    ("title", "TEXT"), ("publisher", "TEXT")]:
+            if column not in existing:
+                c.execute(f"ALTER TABLE pdf_texts ADD COLUMN {column} {declaration}")
+        for column in ("author", "year", "title", "publisher"):
+            c.execute(f"CREATE INDEX IF NOT EXISTS idx_pdf_texts_{column} ON pdf_texts ({column})")
         conn.commit()
 
 # ---------------------
 # PDF Processing Logic
 # ---------------------
-def download_blob(blob_name):
+def extract_text_from_pdf_with_recognition(pdf_bytes):
     """
-    Downloads a PDF from Azure Blob Storage and saves it locally.
+    Sends a PDF (bytes or an open binary file) to Azure Form Recognizer 
+    (using the prebuilt-layout model) for text extraction. Returns None on error.
     """
-    try:
-        local_path = os.path.join(PDF_DOWNLOAD_PATH, blob_name)
-        blob_client = container_client.get_blob_client(blob_name)
-        with open(local_path, "wb") as download_file:
-            download_file.write(blob_client.download_blob().readall())
-        logging.info(f"Downloaded and saved PDF to: {local_path}")
-        return local_path
-    except Exception as e:
-        logging.error(f"Error downloading blob {blob_name}: {e}")
-        return None
+    page_texts = recognize_page_texts(pdf_bytes)
+    return None if page_texts is None else "".join(page_texts)
 
-def extract_text_from_pdf_with_recognition(pdf_bytes):
+def recognize_page_texts(pdf):
     """
-    Saves PDF bytes to a temporary file, sends the file to Azure Form Recognizer 
-    (using the prebuilt-layout model) for text extraction, and removes the temporary file.
+    Runs the prebuilt-layout model on a PDF (bytes, an open binary file or a file path; files are
+    streamed to the service rather than read into memory) and returns the text of each page, in
+    page order. Returns None on error.
     """
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-            tmp_file.write(pdf_bytes)
-            tmp_filename = tmp_file.name
-        logging.info(f"Temporary PDF saved to: {tmp_filename}")
-        
         document_analysis_client = DocumentAnalysisClient(
             form_recognizer_endpoint, AzureKeyCredential(form_recognizer_key)
         )
-        
-        with open(tmp_filename, "rb") as f:
-            poller = document_analysis_client.begin_analyze_document("prebuilt-layout", f)
+        if isinstance(pdf, str):
+            with open(pdf, "rb") as pdf_file:
+                poller = document_analysis_client.begin_analyze_document("prebuilt-layout", pdf_file)
+                result = poller.result()
+        else:
+            if not isinstance(pdf, (bytes, bytearray)):
+                pdf.seek(0)
+            poller = document_analysis_client.begin_analyze_document("prebuilt-layout", pdf)
             result = poller.result()
-        
-        extracted_text = ""
-        for page in result.pages:
-            for line in page.lines:
-                extracted_text += line.content + "\n"
-        
-        os.remove(tmp_filename)
-        logging.info("Temporary PDF file removed.")
-        return extracted_text
+        return ["".join(line.content + "\n" for line in page.lines) for page in result.pages]
     except Exception as e:
         logging.error(f"Error extracting text from PDF using Form Recognizer: {e}")
-        return ""
+        return None
+
+def extract_text_hybrid(pdf):
+    """
+    Extracts the embedded text layer locally with PyMuPDF and sends only the pages without a
+    usable text layer to Form Recognizer, as a single PDF of just those pages. Born-digital PDFs
+    never leave the process; page order is kept. Accepts bytes or a stream from
+    download_blob_stream. Returns None if Form Recognizer was needed and failed, so a failed
+    extraction is never stored as empty or partial text.
+    """
+    with tempfile.TemporaryDirectory() as scratch:
+        try:
+            with open_pdf_document(pdf) as doc:
+                page_texts = [page.get_text("text", sort=True) for page in doc]
+                scanned = [i for i, text in enumerate(page_texts)
+                           if sum(ch.isalnum() for ch in text) < LOCAL_TEXT_MIN_CHARS]
+                # A fully scanned PDF is uploaded as is rather than copied page by page; a partly
+                # scanned one has just those pages saved to disk and streamed from there
+                scanned_pdf = pdf
+                if scanned and len(scanned) < len(page_texts):
+                    scanned_pdf = os.path.join(scratch, "scanned.pdf")
+                    with fitz.open() as subset:
+                        for page_index in scanned:
+                            subset.insert_pdf(doc, from_page=page_index, to_page=page_index)
+                        subset.save(scanned_pdf)
+        except Exception as e:
+            logging.warning(f"PyMuPDF could not open the PDF, using Form Recognizer for all pages: {e}")
+            return extract_text_from_pdf_with_recognition(pdf)
+
+        if scanned:
+            logging.info(f"Sending {len(scanned)} of {len(page_texts)} pages without a text layer to Form Recognizer")
+            recognized = recognize_page_texts(scanned_pdf)
+            if recognized is None:
+                return None
+            if len(recognized) != len(scanned):
+                logging.error(f"Form Recognizer returned {len(recognized)} pages for {len(scanned)}")
+                return None
+            for page_index, text in zip(scanned, recognized):
+                page_texts[page_index] = text
+    return "\n".join(page_texts)
+
+@contextlib.contextmanager
+def open_pdf_document(pdf):
+    """
+    Opens bytes or a downloaded PDF stream with PyMuPDF. In-memory buffers (bounded by
+    DOWNLOAD_SPOOL_MAX_BYTES) are read through a view of the buffer rather than a copy;
+    file-backed ones are opened by path so PyMuPDF reads pages from disk instead of loading the
+    whole file.
+    """
+    if isinstance(pdf, (bytes, bytearray)):
+        with fitz.open(stream=pdf, filetype="pdf") as doc:
+            yield doc
+    elif isinstance(pdf, io.BytesIO):
+        # The view is released on exit, so the caller can still close the buffer
+        with pdf.getbuffer() as view, fitz.open(stream=view, filetype="pdf") as doc:
+            yield doc
+    else:
+        with fitz.open(pdf.name, filetype="pdf") as doc:
+            yield doc
+
+def download_blob_stream(blob_name):
+    """
+    Streams a blob in DOWNLOAD_CHUNK_BYTES chunks into a single buffer and returns it as an
+    open binary file positioned at the start (or None on error): memory for small PDFs, a
+    temporary file for large ones, or the file in BLOB_CACHE_PATH when the cache is enabled.
+    The caller closes it.
+    """
+    try:
+        blob_client = container_client.get_blob_client(blob_name)
+        if BLOB_CACHE_PATH:
+            etag = blob_client.get_blob_properties().etag
+            cached = cached_blob_path(blob_name, etag)
+            if cached:
+                logging.info(f"Using cached copy of {blob_name}: {cached}")
+                return open(cached, "rb")
+        downloader = blob_client.download_blob()
+        if BLOB_CACHE_PATH:
+            os.makedirs(BLOB_CACHE_PATH, exist_ok=True)
+            buffer = tempfile.NamedTemporaryFile(dir=BLOB_CACHE_PATH, suffix=".part", delete=False)
+        elif downloader.size <= DOWNLOAD_SPOOL_MAX_BYTES:
+            buffer = io.BytesIO()
+        else:
+            buffer = tempfile.NamedTemporaryFile(suffix=".pdf")
+        try:
+            digest = hashlib.sha256()
+            for chunk in downloader.chunks():
+                digest.update(chunk)
+                buffer.write(chunk)
+            logging.info(f"Downloaded {blob_name} ({downloader.size} bytes)")
+            if BLOB_CACHE_PATH:
+                buffer.close()
+                # The ETag of the content actually downloaded, not of the earlier properties call
+                path = store_cached_blob(blob_name, downloader.properties.etag, digest.hexdigest(), buffer.name)
+                return open(path, "rb")
+            buffer.seek(0)
+            return buffer
+        except Exception:
+            buffer.close()
+            raise
+        finally:
+            # store_cached_blob moves or removes the part file; this only runs after a failure
+            if BLOB_CACHE_PATH and os.path.exists(buffer.name):
+                os.remove(buffer.name)
+    except Exception as e:
+        logging.error(f"Error downloading blob {blob_name}: {e}")
+        return None
+
+def blob_cache_db():
+    # Shared by every download thread: WAL lets readers proceed during a write, and the timeout
+    # makes concurrent writers wait for the lock instead of failing with "database is locked"
+    conn = sqlite3.connect(os.path.join(BLOB_CACHE_PATH, "index.db"), timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS blob_cache (
+            blob_name TEXT PRIMARY KEY,
+            etag TEXT NOT NULL,
+            sha256 TEXT NOT NULL
+        )
+    """)
+    return conn
+
+def cached_blob_path(blob_name, etag):
+    """
+    Returns the cached file for a blob if its ETag is unchanged since it was stored, else None.
+    """
+    if not os.path.isdir(BLOB_CACHE_PATH):
+        return None
+    with blob_cache_db() as conn:
+        row = conn.execute("SELECT sha256 FROM blob_cache WHERE blob_name = ? AND etag = ?",
+                           (blob_name, etag)).fetchone()
+    if row is None:
+        return None
+    path = os.path.join(BLOB_CACHE_PATH, row[0][:2], row[0] + ".pdf")
+    return path if os.path.exists(path) else None
+
+def store_cached_blob(blob_name, etag, sha256, part_path):
+    """
+    Moves a downloaded file to its content address (identical PDFs under different names are
+    stored once) and records the blob name and ETag that map to it. Returns the cached path.
+    """
+    path = os.path.join(BLOB_CACHE_PATH, sha256[:2], sha256 + ".pdf")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.remove(part_path)
+    else:
+        os.replace(part_path, path)
+    with blob_cache_db() as conn:
+        conn.execute("INSERT OR REPLACE INTO blob_cache (blob_name, etag, sha256) VALUES (?, ?, ?)",
+                     (blob_name, etag, sha256))
+    return path
 
 def clean_extracted_text(text):
     return re.sub(r'\n+', '\n', text).strip()
@@ -148,20 +305,22 @@ def clean_extracted_text(text):
 def process_single_pdf(pdf_name):
     """
     Downloads a PDF from Azure Blob Storage, extracts text using the updated logic,
-    cleans the extracted text, and returns a tuple (pdf_name, cleaned_text).
+    cleans the extracted text, and returns a tuple (pdf_name, cleaned_text, citation_fields).
     """
     try:
         logging.info(f"Processing PDF: {pdf_name}")
-        pdf_path = download_blob(pdf_name)
-        if not pdf_path:
+        pdf_stream = download_blob_stream(pdf_name)
+        if not pdf_stream:
             logging.error(f"Failed to download PDF: {pdf_name}")
             return None
-        with open(pdf_path, "rb") as f:
-            pdf_bytes = f.read()
-        extracted_text = extract_text_from_pdf_with_recognition(pdf_bytes)
+        with pdf_stream:
+            extracted_text = extract_text_hybrid(pdf_stream)
+        if extracted_text is None:
+            logging.error(f"Failed to extract text from PDF: {pdf_name}")
+            return None
         cleaned_text = clean_extracted_text(extracted_text)
         logging.info(f"Extracted text from {pdf_name}: {cleaned_text[:100]}...")
-        return (pdf_name, cleaned_text)
+        return (pdf_name, cleaned_text, build_citation(pdf_name))
     except Exception as e:
         logging.error(f"Error processing PDF {pdf_name}: {e}")
         return None
@@ -170,9 +329,13 @@ def batch_insert_pdfs(records):
     with sqlite3.connect("pdf_cache.db") as conn:
         c = conn.cursor()
         c.executemany('''
-            INSERT INTO pdf_texts (pdf_name, content)
-            VALUES (?, ?)
-        ''', records)
+            INSERT INTO pdf_texts (pdf_name, content, citation, author, year, title, publisher)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [
+            (pdf_name, content, citation["citation"], citation["author"], citation["year"],
+             citation["title"], citation["publisher"])
+            for pdf_name, content, citation in records
+        ])
         conn.commit()
         logging.info(f"Inserted {len(records)} PDFs into the database")
 
@@ -267,19 +430,34 @@ def parse_pdf_metadata(pdf_name):
         return {"author": parts[0], "year": parts[1], "title": parts[2], "publisher": parts[3]}
     return {"author": "Unknown", "year": "n.d.", "title": base_name, "publisher": "Unknown"}
 
+def build_citation(pdf_name):
+    """
+    Returns the indexed citation columns for a PDF: the APA string plus author, numeric year,
+    title and publisher.
+    """
+    metadata = parse_pdf_metadata(pdf_name)
+    year = metadata["year"]
+    return {
+        "citation": f"{metadata['author']} ({year}). {metadata['title']}. {metadata['publisher']}.",
+        "author": metadata["author"],
+        "year": int(year) if year.isdigit() else None,
+        "title": metadata["title"],
+        "publisher": metadata["publisher"]
+    }
+
 def search_pdfs_helper(user_message, max_paragraphs=5):
     relevant_paragraphs = []
     try:
         with sqlite3.connect("pdf_cache.db") as conn:
             c = conn.cursor()
-            c.execute("SELECT pdf_name, content FROM pdf_texts")
-            pdfs = [{"name": row[0], "content": row[1]} for row in c.fetchall()]
+            c.execute("SELECT pdf_name, content, citation FROM pdf_texts")
+            pdfs = [{"name": row[0], "content": row[1], "citation": row[2]} for row in c.fetchall()]
     except Exception as e:
         logging.error(f"Error retrieving PDFs from cache: {e}")
         return relevant_paragraphs
     for pdf in pdfs:
-        metadata = parse_pdf_metadata(pdf["name"])
-        apa_citation = f"{metadata['author']} ({metadata['year']}). {metadata['title']}. {metadata['publisher']}."
+        # Rows inserted before the citation column existed are parsed on the fly
+        apa_citation = pdf["citation"] or build_citation(pdf["name"])["citation"]
         paragraphs = [p.strip() for p in pdf["content"].split("\n") if p.strip()]
         for paragraph in paragraphs:
             if is_relevant(paragraph, user_message):
@@ -726,6 +904,9 @@ import re
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 import tempfile
+import hashlib
+import io
+import contextlib
 
 # Configure logging with INFO level
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -751,16 +932,27 @@ azure_blob_connection_string = ("DefaultEndpointsProtocol=https;"
                                   "AccountKey=wJh4mvSgbEOoOFfcDsLVX7GSIzw59gkJF0Do77rOmOv60EFCODcNvNTaHVusWcVrvnLtkK3x4wX5+AStWjV9Ew=="
                                   "EndpointSuffix=core.windows.net")
 azure_blob_container_name = "input"
-blob_service_client = BlobServiceClient.from_connection_string(azure_blob_connection_string)
+# Blob downloads are streamed in chunks of DOWNLOAD_CHUNK_BYTES (the first ranged GET included);
+# PDFs up to DOWNLOAD_SPOOL_MAX_BYTES are buffered in memory, larger ones in a temporary file
+DOWNLOAD_CHUNK_BYTES = 4 * 1024 * 1024
+DOWNLOAD_SPOOL_MAX_BYTES = 32 * 1024 * 1024
+blob_service_client = BlobServiceClient.from_connection_string(azure_blob_connection_string,
+                                                               max_single_get_size=DOWNLOAD_CHUNK_BYTES,
+                                                               max_chunk_get_size=DOWNLOAD_CHUNK_BYTES)
 container_client = blob_service_client.get_container_client(azure_blob_container_name)
 
 # Form Recognizer configuration (replace with your actual key if available)
 form_recognizer_endpoint = "https://documentanalysisclient.cognitiveservices.azure.com/"
 form_recognizer_key = "YOUR_FORM_RECOGNIZER_KEY"  # Replace with your actual Form Recognizer key
 
-# Local directory to store downloaded PDFs
-PDF_DOWNLOAD_PATH = "downloaded_pdfs"
-os.makedirs(PDF_DOWNLOAD_PATH, exist_ok=True)
+# Optional content-addressed blob cache: PDFs are stored once per SHA-256 under this directory
+# and looked up by blob name and ETag, so unchanged blobs are never downloaded twice.
+# None disables it.
+BLOB_CACHE_PATH = None
+
+# Minimum number of letters and digits a page's embedded text layer needs to be used as is;
+# pages below it (scans, image-only pages) are sent to Form Recognizer
+LOCAL_TEXT_MIN_CHARS = 50
 
 # ---------------------
 # Database Initialization Functions
@@ -803,56 +995,199 @@ def init_pdf_cache_db():
                 content TEXT NOT NULL
             )
         ''')
+        # Citation fields computed once at ingest so search_pdfs_helper never re-parses file names
+        existing = {row[1] for row in c.execute("PRAGMA table_info(pdf_texts)").fetchall()}
+        for column, declaration in [("citation", "TEXT"), ("author", "TEXT"), ("year", "INTEGER"),
+                                    ("title", "TEXT"), ("publisher", "TEXT")]:
+            if column not in existing:
+                c.execute(f"ALTER TABLE pdf_texts ADD COLUMN {column} {declaration}")
+        for column in ("author", "year", "title", "publisher"):
+            c.execute(f"CREATE INDEX IF NOT EXISTS idx_pdf_texts_{column} ON pdf_texts ({column})")
         conn.commit()
 
 # ---------------------
 # PDF Processing Logic
 # ---------------------
-def download_blob(blob_name):
+def extract_text_from_pdf_with_recognition(pdf_bytes):
     """
-    Downloads a PDF from Azure Blob Storage and saves it locally.
+    Sends a PDF (bytes or an open binary file) to Azure Form Recognizer 
+    (using the prebuilt-layout model) for text extraction. Returns None on error.
     """
-    try:
-        local_path = os.path.join(PDF_DOWNLOAD_PATH, blob_name)
-        blob_client = container_client.get_blob_client(blob_name)
-        with open(local_path, "wb") as download_file:
-            download_file.write(blob_client.download_blob().readall())
-        logging.info(f"Downloaded and saved PDF to: {local_path}")
-        return local_path
-    except Exception as e:
-        logging.error(f"Error downloading blob {blob_name}: {e}")
-        return None
+    page_texts = recognize_page_texts(pdf_bytes)
+    return None if page_texts is None else "".join(page_texts)
 
-def extract_text_from_pdf_with_recognition(pdf_bytes):
+def recognize_page_texts(pdf):
     """
-    Saves PDF bytes to a temporary file, sends the file to Azure Form Recognizer 
-    (using the prebuilt-layout model) for text extraction, and removes the temporary file.
+    Runs the prebuilt-layout model on a PDF (bytes, an open binary file or a file path; files are
+    streamed to the service rather than read into memory) and returns the text of each page, in
+    page order. Returns None on error.
     """
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-            tmp_file.write(pdf_bytes)
-            tmp_filename = tmp_file.name
-        logging.info(f"Temporary PDF saved to: {tmp_filename}")
-        
         document_analysis_client = DocumentAnalysisClient(
             form_recognizer_endpoint, AzureKeyCredential(form_recognizer_key)
         )
-        
-        with open(tmp_filename, "rb") as f:
-            poller = document_analysis_client.begin_analyze_document("prebuilt-layout", f)
+        if isinstance(pdf, str):
+            with open(pdf, "rb") as pdf_file:
+                poller = document_analysis_client.begin_analyze_document("prebuilt-layout", pdf_file)
+                result = poller.result()
+        else:
+            if not isinstance(pdf, (bytes, bytearray)):
+                pdf.seek(0)
+            poller = document_analysis_client.begin_analyze_document("prebuilt-layout", pdf)
             result = poller.result()
-        
-        extracted_text = ""
-        for page in result.pages:
-            for line in page.lines:
-                extracted_text += line.content + "\n"
-        
-        os.remove(tmp_filename)
-        logging.info("Temporary PDF file removed.")
-        return extracted_text
+        return ["".join(line.content + "\n" for line in page.lines) for page in result.pages]
     except Exception as e:
         logging.error(f"Error extracting text from PDF using Form Recognizer: {e}")
-        return ""
+        return None
+
+def extract_text_hybrid(pdf):
+    """
+    Extracts the embedded text layer locally with PyMuPDF and sends only the pages without a
+    usable text layer to Form Recognizer, as a single PDF of just those pages. Born-digital PDFs
+    never leave the process; page order is kept. Accepts bytes or a stream from
+    download_blob_stream. Returns None if Form Recognizer was needed and failed, so a failed
+    extraction is never stored as empty or partial text.
+    """
+    with tempfile.TemporaryDirectory() as scratch:
+        try:
+            with open_pdf_document(pdf) as doc:
+                page_texts = [page.get_text("text", sort=True) for page in doc]
+                scanned = [i for i, text in enumerate(page_texts)
+                           if sum(ch.isalnum() for ch in text) < LOCAL_TEXT_MIN_CHARS]
+                # A fully scanned PDF is uploaded as is rather than copied page by page; a partly
+                # scanned one has just those pages saved to disk and streamed from there
+                scanned_pdf = pdf
+                if scanned and len(scanned) < len(page_texts):
+                    scanned_pdf = os.path.join(scratch, "scanned.pdf")
+                    with fitz.open() as subset:
+                        for page_index in scanned:
+                            subset.insert_pdf(doc, from_page=page_index, to_page=page_index)
+                        subset.save(scanned_pdf)
+        except Exception as e:
+            logging.warning(f"PyMuPDF could not open the PDF, using Form Recognizer for all pages: {e}")
+            return extract_text_from_pdf_with_recognition(pdf)
+
+        if scanned:
+            logging.info(f"Sending {len(scanned)} of {len(page_texts)} pages without a text layer to Form Recognizer")
+            recognized = recognize_page_texts(scanned_pdf)
+            if recognized is None:
+                return None
+            if len(recognized) != len(scanned):
+                logging.error(f"Form Recognizer returned {len(recognized)} pages for {len(scanned)}")
+                return None
+            for page_index, text in zip(scanned, recognized):
+                page_texts[page_index] = text
+    return "\n".join(page_texts)
+
+@contextlib.contextmanager
+def open_pdf_document(pdf):
+    """
+    Opens bytes or a downloaded PDF stream with PyMuPDF. In-memory buffers (bounded by
+    DOWNLOAD_SPOOL_MAX_BYTES) are read through a view of the buffer rather than a copy;
+    file-backed ones are opened by path so PyMuPDF reads pages from disk instead of loading the
+    whole file.
+    """
+    if isinstance(pdf, (bytes, bytearray)):
+        with fitz.open(stream=pdf, filetype="pdf") as doc:
+            yield doc
+    elif isinstance(pdf, io.BytesIO):
+        # The view is released on exit, so the caller can still close the buffer
+        with pdf.getbuffer() as view, fitz.open(stream=view, filetype="pdf") as doc:
+            yield doc
+    else:
+        with fitz.open(pdf.name, filetype="pdf") as doc:
+            yield doc
+
+def download_blob_stream(blob_name):
+    """
+    Streams a blob in DOWNLOAD_CHUNK_BYTES chunks into a single buffer and returns it as an
+    open binary file positioned at the start (or None on error): memory for small PDFs, a
+    temporary file for large ones, or the file in BLOB_CACHE_PATH when the cache is enabled.
+    The caller closes it.
+    """
+    try:
+        blob_client = container_client.get_blob_client(blob_name)
+        if BLOB_CACHE_PATH:
+            etag = blob_client.get_blob_properties().etag
+            cached = cached_blob_path(blob_name, etag)
+            if cached:
+                logging.info(f"Using cached copy of {blob_name}: {cached}")
+                return open(cached, "rb")
+        downloader = blob_client.download_blob()
+        if BLOB_CACHE_PATH:
+            os.makedirs(BLOB_CACHE_PATH, exist_ok=True)
+            buffer = tempfile.NamedTemporaryFile(dir=BLOB_CACHE_PATH, suffix=".part", delete=False)
+        elif downloader.size <= DOWNLOAD_SPOOL_MAX_BYTES:
+            buffer = io.BytesIO()
+        else:
+            buffer = tempfile.NamedTemporaryFile(suffix=".pdf")
+        try:
+            digest = hashlib.sha256()
+            for chunk in downloader.chunks():
+                digest.update(chunk)
+                buffer.write(chunk)
+            logging.info(f"Downloaded {blob_name} ({downloader.size} bytes)")
+            if BLOB_CACHE_PATH:
+                buffer.close()
+                # The ETag of the content actually downloaded, not of the earlier properties call
+                path = store_cached_blob(blob_name, downloader.properties.etag, digest.hexdigest(), buffer.name)
+                return open(path, "rb")
+            buffer.seek(0)
+            return buffer
+        except Exception:
+            buffer.close()
+            raise
+        finally:
+            # store_cached_blob moves or removes the part file; this only runs after a failure
+            if BLOB_CACHE_PATH and os.path.exists(buffer.name):
+                os.remove(buffer.name)
+    except Exception as e:
+        logging.error(f"Error downloading blob {blob_name}: {e}")
+        return None
+
+def blob_cache_db():
+    # Shared by every download thread: WAL lets readers proceed during a write, and the timeout
+    # makes concurrent writers wait for the lock instead of failing with "database is locked"
+    conn = sqlite3.connect(os.path.join(BLOB_CACHE_PATH, "index.db"), timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS blob_cache (
+            blob_name TEXT PRIMARY KEY,
+            etag TEXT NOT NULL,
+            sha256 TEXT NOT NULL
+        )
+    """)
+    return conn
+
+def cached_blob_path(blob_name, etag):
+    """
+    Returns the cached file for a blob if its ETag is unchanged since it was stored, else None.
+    """
+    if not os.path.isdir(BLOB_CACHE_PATH):
+        return None
+    with blob_cache_db() as conn:
+        row = conn.execute("SELECT sha256 FROM blob_cache WHERE blob_name = ? AND etag = ?",
+                           (blob_name, etag)).fetchone()
+    if row is None:
+        return None
+    path = os.path.join(BLOB_CACHE_PATH, row[0][:2], row[0] + ".pdf")
+    return path if os.path.exists(path) else None
+
+def store_cached_blob(blob_name, etag, sha256, part_path):
+    """
+    Moves a downloaded file to its content address (identical PDFs under different names are
+    stored once) and records the blob name and ETag that map to it. Returns the cached path.
+    """
+    path = os.path.join(BLOB_CACHE_PATH, sha256[:2], sha256 + ".pdf")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.remove(part_path)
+    else:
+        os.replace(part_path, path)
+    with blob_cache_db() as conn:
+        conn.execute("INSERT OR REPLACE INTO blob_cache (blob_name, etag, sha256) VALUES (?, ?, ?)",
+                     (blob_name, etag, sha256))
+    return path
 
 def clean_extracted_text(text):
     return re.sub(r'\n+', '\n', text).strip()
@@ -860,20 +1195,22 @@ def clean_extracted_text(text):
 def process_single_pdf(pdf_name):
     """
     Downloads a PDF from Azure Blob Storage, extracts text using the updated logic,
-    cleans the extracted text, and returns a tuple (pdf_name, cleaned_text).
+    cleans the extracted text, and returns a tuple (pdf_name, cleaned_text, citation_fields).
     """
     try:
         logging.info(f"Processing PDF: {pdf_name}")
-        pdf_path = download_blob(pdf_name)
-        if not pdf_path:
+        pdf_stream = download_blob_stream(pdf_name)
+        if not pdf_stream:
             logging.error(f"Failed to download PDF: {pdf_name}")
             return None
-        with open(pdf_path, "rb") as f:
-            pdf_bytes = f.read()
-        extracted_text = extract_text_from_pdf_with_recognition(pdf_bytes)
+        with pdf_stream:
+            extracted_text = extract_text_hybrid(pdf_stream)
+        if extracted_text is None:
+            logging.error(f"Failed to extract text from PDF: {pdf_name}")
+            return None
         cleaned_text = clean_extracted_text(extracted_text)
         logging.info(f"Extracted text from {pdf_name}: {cleaned_text[:100]}...")
-        return (pdf_name, cleaned_text)
+        return (pdf_name, cleaned_text, build_citation(pdf_name))
     except Exception as e:
         logging.error(f"Error processing PDF {pdf_name}: {e}")
         return None
@@ -882,9 +1219,13 @@ def batch_insert_pdfs(records):
     with sqlite3.connect("pdf_cache.db") as conn:
         c = conn.cursor()
         c.executemany('''
-            INSERT INTO pdf_texts (pdf_name, content)
-            VALUES (?, ?)
-        ''', records)
+            INSERT INTO pdf_texts (pdf_name, content, citation, author, year, title, publisher)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [
+            (pdf_name, content, citation["citation"], citation["author"], citation["year"],
+             citation["title"], citation["publisher"])
+            for pdf_name, content, citation in records
+        ])
         conn.commit()
         logging.info(f"Inserted {len(records)} PDFs into the database")
 
@@ -979,19 +1320,34 @@ def parse_pdf_metadata(pdf_name):
         return {"author": parts[0], "year": parts[1], "title": parts[2], "publisher": parts[3]}
     return {"author": "Unknown", "year": "n.d.", "title": base_name, "publisher": "Unknown"}
 
+def build_citation(pdf_name):
+    """
+    Returns the indexed citation columns for a PDF: the APA string plus author, numeric year,
+    title and publisher.
+    """
+    metadata = parse_pdf_metadata(pdf_name)
+    year = metadata["year"]
+    return {
+        "citation": f"{metadata['author']} ({year}). {metadata['title']}. {metadata['publisher']}.",
+        "author": metadata["author"],
+        "year": int(year) if year.isdigit() else None,
+        "title": metadata["title"],
+        "publisher": metadata["publisher"]
+    }
+
 def search_pdfs_helper(user_message, max_paragraphs=5):
     relevant_paragraphs = []
     try:
         with sqlite3.connect("pdf_cache.db") as conn:
             c = conn.cursor()
-            c.execute("SELECT pdf_name, content FROM pdf_texts")
-            pdfs = [{"name": row[0], "content": row[1]} for row in c.fetchall()]
+            c.execute("SELECT pdf_name, content, citation FROM pdf_texts")
+            pdfs = [{"name": row[0], "content": row[1], "citation": row[2]} for row in c.fetchall()]
     except Exception as e:
         logging.error(f"Error retrieving PDFs from cache: {e}")
         return relevant_paragraphs
     for pdf in pdfs:
-        metadata = parse_pdf_metadata(pdf["name"])
-        apa_citation = f"{metadata['author']} ({metadata['year']}). {metadata['title']}. {metadata['publisher']}."
+        # Rows inserted before the citation column existed are parsed on the fly
+        apa_citation = pdf["citation"] or build_citation(pdf["name"])["citation"]
         paragraphs = [p.strip() for p in pdf["content"].split("\n") if p.strip()]
         for paragraph in paragraphs:
             if is_relevant(paragraph, user_message):
@@ -3,7 +3,8 @@ from werkzeug.security import generate_password_hash, check_password_hash
 import requests
 from azure.storage.blob import BlobServiceClient
 import fitz  # PyMuPDF
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import time
 import json
 import sqlite3
@@ -15,9 +16,25 @@ from openai import AzureOpenAI
 from flasgger import Swagger, swag_from
 import logging
 import re
+import math
+import heapq
+from itertools import islice
+from collections import OrderedDict, Counter
+from functools import lru_cache
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 import uuid  # For generating conversation IDs
+import sys
+import threading
+import queue
+import multiprocessing
+import os
+import zlib
+import tempfile
+import hashlib
+import mmap
+import struct
+import numpy as np
 
 # Configure logging with INFO level
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -54,6 +71,104 @@ container_client = blob_service_client.get_container_client(azure_blob_container
 FORM_RECOGNIZER_ENDPOINT = "https://documentanalysisclient.cognitiveservices.azure.com/"
 FORM_RECOGNIZER_KEY = ""
 
+# Version of the data derived from pdf_texts at ingest (paragraph chunks, search indexes, citation
+# columns, term Bloom filters, near-duplicate links), stored as PRAGMA user_version. Bump it when that
+# derivation changes; init_pdf_cache_db then rebuilds older databases with rebuild_pdf_search_index
+PDF_CACHE_SCHEMA_VERSION = 1
+
+# Ingest-time chunking of PDF text into the retrieval units stored in pdf_paragraphs: chunks grow
+# line by line up to CHUNK_MAX_CHARS, end at a blank line once CHUNK_MIN_CHARS is reached, and
+# repeat up to CHUNK_OVERLAP_CHARS of trailing lines when split mid-block (CHUNK_MAX_CHARS = 0
+# keeps one unit per line)
+CHUNK_MAX_CHARS = 1200
+CHUNK_MIN_CHARS = 400
+CHUNK_OVERLAP_CHARS = 200
+
+# Near-duplicate chunk detection at ingest: MinHash signature size, LSH bands (signature rows per
+# band = MINHASH_PERMUTATIONS / MINHASH_BANDS), the estimated Jaccard similarity above which a chunk
+# is a copy of an earlier one, and the minimum token count for a chunk to be checked at all
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 8
+MINHASH_THRESHOLD = 0.8
+MINHASH_MIN_TOKENS = 8
+
+# Form Recognizer paragraph roles left out of the extracted text
+SKIPPED_PARAGRAPH_ROLES = {"pageHeader", "pageFooter", "pageNumber"}
+
+# Minimum number of letters and digits a page's embedded text layer needs to be used as is;
+# pages below it (scans, image-only pages) are sent to Form Recognizer
+LOCAL_TEXT_MIN_CHARS = 50
+
+# Process pool shared by sharded retrieval and parallel text extraction. Every web worker gets
+# its own pool, so it stays small; workers are started with forkserver because forking a
+# multithreaded server process can deadlock on locks held by other threads
+WORKER_PROCESSES = min(4, os.cpu_count() or 1)
+WORKER_START_METHOD = "forkserver"
+
+# Local text extraction of large PDFs is split into page ranges of EXTRACT_PAGES_PER_TASK pages
+# parsed in the worker pool; PDFs under EXTRACT_PARALLEL_MIN_PAGES pages (or a single worker
+# process) are parsed in the calling thread
+EXTRACT_PAGES_PER_TASK = 32
+EXTRACT_PARALLEL_MIN_PAGES = 64
+
+# Staged ingestion pipeline (list -> download -> extract -> chunk -> insert): worker threads per
+# stage (the container listing is one paged iteration, so "list" always has a single worker),
+# capacity of the bounded queue in front of each stage, most PDFs committed per insert
+# transaction, and how often, in seconds, per-stage progress is logged
+INGEST_STAGE_WORKERS = {"download": 8, "extract": 8, "chunk": 2, "insert": 1}
+INGEST_QUEUE_SIZE = 16
+INGEST_INSERT_BATCH = 100
+INGEST_REPORT_INTERVAL = 30.0
+
+# BM25 parameters for ranked PDF paragraph retrieval
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# In-process corpus cache: estimated memory ceiling per worker (0 disables it) and how often,
+# in seconds, warm requests re-check the corpus generation stored in pdf_cache.db
+CORPUS_CACHE_MAX_BYTES = 512 * 1024 * 1024
+CORPUS_CACHE_CHECK_INTERVAL = 5.0
+
+# Query-result cache in front of search_pdfs_helper: maximum entries and time-to-live in seconds
+QUERY_CACHE_MAX_ENTRIES = 1024
+QUERY_CACHE_TTL = 300.0
+
+# Retriever used by search_pdfs_helper: "bm25" (FTS5 index / corpus cache), "tfidf" (hashed TF-IDF vectors)
+# or "sharded" (BM25 over the FTS5 index, split into SHARD_WORKERS shards scored in the worker pool)
+PDF_RETRIEVER = "bm25"
+TFIDF_INDEX_PATH = "pdf_tfidf.npz"
+TFIDF_HASH_BITS = 18
+SHARD_WORKERS = WORKER_PROCESSES
+
+# Compact corpus file (UTF-8 paragraph text, offsets and metadata ids) that worker processes mmap
+CORPUS_FILE_PATH = "pdf_corpus.bin"
+
+# /search_pdfs paging and snippet settings
+SEARCH_PAGE_SIZE_DEFAULT = 10
+SEARCH_PAGE_SIZE_MAX = 50
+SNIPPET_CHARS = 240
+
+# Two-stage retrieval in search_pdfs_helper: stage 1 fetches RERANK_CANDIDATES ranked paragraphs
+# (0 disables reranking), stage 2 rescores them with local features for at most RERANK_TIME_BUDGET_MS
+RERANK_CANDIDATES = 200
+RERANK_TIME_BUDGET_MS = 50.0
+RERANK_WEIGHTS = {"retrieval": 1.0, "coverage": 1.0, "proximity": 0.5, "recency": 0.2}
+RERANK_RECENCY_HALF_LIFE = 10  # years
+
+# Largest number of queries accepted by /search_pdfs/batch
+SEARCH_BATCH_MAX_QUERIES = 500
+# Words in more than this fraction of paragraphs are kept out of the batch's shared full-text
+# pass (their postings would dominate it); queries using them are answered one by one
+BATCH_UNION_MAX_DF = 0.05
+
+# Token distance used for `a NEAR b` when no explicit NEAR/k is given
+NEAR_DEFAULT_DISTANCE = 10
+
+# Per-document Bloom filters used by the pdf_texts scan: bits per entry and probes per entry
+# (10 bits and 7 probes give roughly a 1% false-positive rate)
+TERM_BLOOM_BITS_PER_ENTRY = 10
+TERM_BLOOM_HASHES = 7
+
 # ---------------------
 # Database Initialization Functions
 # ---------------------
@@ -85,7 +200,105 @@ def init_pdf_cache_db():
                 metadata TEXT
             )
         ''')
+        # Citation fields computed once at ingest so retrieval never parses metadata per query
+        add_missing_columns(c, "pdf_texts", [
+            ("citation", "TEXT"),
+            ("author", "TEXT"),
+            ("year", "INTEGER"),
+            ("title", "TEXT"),
+            ("publisher", "TEXT"),
+            ("term_bloom", "BLOB")
+        ])
+        c.execute('CREATE INDEX IF NOT EXISTS idx_pdf_texts_year ON pdf_texts (year)')
+        # Text filters compare case-insensitively, so their indexes use the same collation
+        for column in METADATA_TEXT_COLUMNS:
+            c.execute(f'DROP INDEX IF EXISTS idx_pdf_texts_{column}')
+            c.execute(f'CREATE INDEX IF NOT EXISTS idx_pdf_texts_{column}_nocase ON pdf_texts ({column} COLLATE NOCASE)')
+        # batch_insert_pdfs replaces earlier rows of the same PDF, looked up by name
+        c.execute('CREATE INDEX IF NOT EXISTS idx_pdf_texts_pdf_name ON pdf_texts (pdf_name)')
+        # One row per blob ingested from the container, so refreshes only process new or changed blobs
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS pdf_ingest_manifest (
+                blob_name TEXT PRIMARY KEY,
+                etag TEXT,
+                size INTEGER,
+                last_modified TEXT,
+                ingested_at TEXT NOT NULL
+            )
+        ''')
+        # Paragraphs materialized once at ingest; offsets are character positions in pdf_texts.content
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS pdf_paragraphs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                pdf_id INTEGER NOT NULL REFERENCES pdf_texts(id),
+                ordinal INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                char_start INTEGER NOT NULL,
+                char_end INTEGER NOT NULL,
+                page_number INTEGER,
+                length INTEGER NOT NULL
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_pdf_paragraphs_pdf ON pdf_paragraphs (pdf_id, ordinal)')
+        # canonical_id points near-duplicate copies at the paragraph that is indexed in their place
+        add_missing_columns(c, "pdf_paragraphs", [
+            ("canonical_id", "INTEGER"),
+            ("minhash", "BLOB")
+        ])
+        c.execute('CREATE INDEX IF NOT EXISTS idx_pdf_paragraphs_canonical ON pdf_paragraphs (canonical_id)')
+        # LSH buckets of the canonical paragraphs' MinHash signatures
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS pdf_paragraph_lsh (
+                band INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                paragraph_id INTEGER NOT NULL REFERENCES pdf_paragraphs(id)
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_pdf_paragraph_lsh ON pdf_paragraph_lsh (band, bucket)')
+        # Full-text index over pdf_paragraphs.text used by search_pdfs_helper; rowid is pdf_paragraphs.id
+        c.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS pdf_paragraphs_fts USING fts5(
+                text,
+                content='pdf_paragraphs',
+                content_rowid='id'
+            )
+        ''')
+        # Trigram index over the same paragraphs so substring (LIKE '%term%') searches are index probes
+        c.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS pdf_paragraphs_trigram USING fts5(
+                text,
+                content='pdf_paragraphs',
+                content_rowid='id',
+                tokenize='trigram'
+            )
+        ''')
+        # Per-term document frequencies maintained by FTS5, used for BM25 scoring
+        c.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS pdf_paragraphs_vocab
+            USING fts5vocab(pdf_paragraphs_fts, 'row')
+        ''')
+        # Corpus-wide counters (paragraph_count, token_count) for BM25 length normalization
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS pdf_index_stats (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )
+        ''')
         conn.commit()
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        stale = version < PDF_CACHE_SCHEMA_VERSION and c.execute("SELECT 1 FROM pdf_texts LIMIT 1").fetchone()
+        if version < PDF_CACHE_SCHEMA_VERSION and not stale:
+            c.execute(f"PRAGMA user_version = {PDF_CACHE_SCHEMA_VERSION}")
+    if stale:
+        logging.info(f"pdf_cache.db has schema version {version}, rebuilding it for version {PDF_CACHE_SCHEMA_VERSION}")
+        rebuild_pdf_search_index()
+
+def add_missing_columns(c, table, columns):
+    # CREATE TABLE IF NOT EXISTS leaves older databases alone, so new columns are added here
+    existing = {row[1] for row in c.execute(f"PRAGMA table_info({table})").fetchall()}
+    for name, declaration in columns:
+        if name not in existing:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {name} {declaration}")
 
 def init_user_db():
     with sqlite3.connect("user_data.db") as conn:
@@ -128,67 +341,237 @@ def load_chat_history():
 def extract_text_and_metadata_from_pdf(pdf_bytes):
     """
     Uses the Form Recognizer prebuilt-document model to extract both text and metadata.
+    Returns None if the analysis fails, so a failed extraction is never stored as empty text.
+    """
+    result = analyze_document(pdf_bytes)
+    if result is None:
+        return None
+    return "\n\f".join(result_page_texts(result)).strip(), result_metadata(result)
+
+def analyze_document(pdf_bytes):
+    """
+    Runs the prebuilt-document model on a PDF and returns the analyze result, or None on error.
     """
     document_analysis_client = DocumentAnalysisClient(endpoint=FORM_RECOGNIZER_ENDPOINT,
                                                         credential=AzureKeyCredential(FORM_RECOGNIZER_KEY))
     try:
         poller = document_analysis_client.begin_analyze_document("prebuilt-document", pdf_bytes)
-        result = poller.result()
-        full_text = ""
-        for page in result.pages:
-            for line in page.lines:
-                full_text += line.content + "\n"
-        # Extract metadata from the first document if available
-        metadata = {}
-        if result.documents:
-            doc = result.documents[0]
-            for field_name, field in doc.fields.items():
-                # Save the field's value if it exists; otherwise, empty string
-                metadata[field_name] = field.value if field.value is not None else ""
-        return full_text.strip(), metadata
+        return poller.result()
     except Exception as e:
         logging.error(f"Error extracting text and metadata from PDF: {e}")
-        return "", {}
+        return None
 
-def process_single_pdf(pdf_name):
+def result_page_texts(result):
+    """
+    Returns the text of each page of an analyze result, in page order. Uses the layout
+    paragraphs when present (one paragraph per block, blocks separated by a blank line, running
+    headers, footers and page numbers dropped), the raw lines otherwise.
+    """
+    if not getattr(result, "paragraphs", None):
+        return ["".join(line.content + "\n" for line in page.lines) for page in result.pages]
+    pages = {page.page_number: [] for page in result.pages}
+    for paragraph in result.paragraphs:
+        if paragraph.role in SKIPPED_PARAGRAPH_ROLES or not paragraph.bounding_regions:
+            continue
+        pages.setdefault(paragraph.bounding_regions[0].page_number, []).append(paragraph.content)
+    return ["\n\n".join(blocks) for _, blocks in sorted(pages.items())]
+
+def result_metadata(result):
+    """
+    Returns the fields of the first document of an analyze result as a plain dict.
+    """
+    metadata = {}
+    if result.documents:
+        doc = result.documents[0]
+        for field_name, field in doc.fields.items():
+            # Save the field's value if it exists; otherwise, empty string
+            metadata[field_name] = field.value if field.value is not None else ""
+    return metadata
+
+# ---------------------
+# Hybrid Text Extraction
+# ---------------------
+def extract_text_and_metadata_hybrid(pdf_bytes, pdf_name=None):
+    """
+    Extracts the embedded text layer locally with PyMuPDF and sends only the pages without a
+    usable text layer to Form Recognizer, as a single PDF of just those pages. Born-digital PDFs
+    never leave the process. Returns the same (text, metadata) pair as
+    extract_text_and_metadata_from_pdf, with pages separated by a form feed, or None if Form
+    Recognizer was needed and failed.
+    """
     try:
-        logging.info(f"Processing PDF: {pdf_name}")
-        pdf_bytes = download_blob(pdf_name)
-        if not pdf_bytes:
-            logging.error(f"Failed to download PDF: {pdf_name}")
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            page_texts = local_page_texts(doc, pdf_bytes)
+            scanned = [i for i, text in enumerate(page_texts) if not has_usable_text(text)]
+            metadata = pdf_info_metadata(doc.metadata, pdf_name)
+            scanned_pdf = subset_pdf_bytes(doc, scanned) if scanned else None
+    except Exception as e:
+        logging.warning(f"PyMuPDF could not open the PDF, using Form Recognizer for all pages: {e}")
+        return extract_text_and_metadata_from_pdf(pdf_bytes)
+
+    if scanned:
+        logging.info(f"Sending {len(scanned)} of {len(page_texts)} pages without a text layer to Form Recognizer")
+        result = analyze_document(scanned_pdf)
+        if result is None:
+            return None
+        recognized = result_page_texts(result)
+        if len(recognized) != len(scanned):
+            logging.error(f"Form Recognizer returned {len(recognized)} pages for {len(scanned)}")
             return None
-        full_text, metadata = extract_text_and_metadata_from_pdf(pdf_bytes)
-        cleaned_text = clean_extracted_text(full_text)
-        logging.info(f"Extracted text from {pdf_name}: {cleaned_text[:100]}...")
-        # Return a tuple with pdf_name, content, and metadata (as JSON string)
-        return (pdf_name, cleaned_text, json.dumps(metadata))
+        for page_index, text in zip(scanned, recognized):
+            page_texts[page_index] = text
+        metadata.update((key, value) for key, value in result_metadata(result).items() if value)
+    return "\n\f".join(page_texts).strip(), metadata
+
+def local_page_text(page):
+    """
+    Returns the embedded text of a PyMuPDF page, one text block per paragraph in reading order,
+    blocks separated by a blank line.
+    """
+    blocks = page.get_text("blocks", sort=True)
+    # Block tuples are (x0, y0, x1, y1, text, block_no, block_type); type 1 is an image
+    return "\n\n".join(block[4].strip() for block in blocks if block[6] == 0 and block[4].strip())
+
+def local_page_texts(doc, pdf_bytes, executor=None, pages_per_task=None):
+    """
+    Returns local_page_text for every page of an open document, in page order. Large PDFs are
+    split into page ranges extracted in parallel by a process pool (the shared worker_pool()
+    unless an executor is given), since PyMuPDF parsing is CPU bound and threads stay GIL-limited.
+    The PDF is written once to a temporary file that every task opens by path, rather than
+    pickled into each task.
+    """
+    pages_per_task = pages_per_task or EXTRACT_PAGES_PER_TASK
+    page_count = len(doc)
+    if executor is None and (WORKER_PROCESSES <= 1 or page_count < EXTRACT_PARALLEL_MIN_PAGES):
+        return [local_page_text(page) for page in doc]
+    pool = executor or worker_pool()
+    try:
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as pdf_file:
+            pdf_file.write(pdf_bytes)
+            pdf_file.flush()
+            futures = [pool.submit(extract_page_range, pdf_file.name, start, min(start + pages_per_task, page_count))
+                       for start in range(0, page_count, pages_per_task)]
+            return [text for future in futures for text in future.result()]
     except Exception as e:
-        logging.error(f"Error processing PDF {pdf_name}: {e}")
+        if isinstance(e, BrokenProcessPool) and executor is None:
+            reset_worker_pool(pool)
+        logging.warning(f"Parallel text extraction failed, extracting in-process: {e}")
+        return [local_page_text(page) for page in doc]
+
+def extract_page_range(pdf_path, start, stop):
+    """
+    Worker task: opens the PDF and returns local_page_text for pages start..stop-1.
+    """
+    with fitz.open(pdf_path, filetype="pdf") as doc:
+        return [local_page_text(doc[page_index]) for page_index in range(start, stop)]
+
+def has_usable_text(text):
+    """
+    True if a page's text layer has enough letters and digits to skip OCR.
+    """
+    return sum(ch.isalnum() for ch in text) >= LOCAL_TEXT_MIN_CHARS
+
+def subset_pdf_bytes(doc, page_indexes):
+    """
+    Returns a new PDF holding only the given pages of an open document, in order.
+    """
+    with fitz.open() as subset:
+        for page_index in page_indexes:
+            subset.insert_pdf(doc, from_page=page_index, to_page=page_index)
+        return subset.tobytes()
+
+def pdf_info_metadata(info, pdf_name=None):
+    """
+    Fills the citation fields the file-name convention (Author_Year_Title_Publisher.pdf) leaves
+    empty from the PDF document information dictionary. A file name that parses wins outright;
+    otherwise only the author (and, with it, the title) is taken, since producer tools fill the
+    title with junk far more often. The year is never taken from creationDate, which is when
+    the file was produced, not when the work was published.
+    """
+    if pdf_name and parse_citation_file_name(pdf_name):
+        return {}
+    info = info or {}
+    author = (info.get("author") or "").strip()
+    if not author:
+        return {}
+    metadata = {"Author": author}
+    title = (info.get("title") or "").strip()
+    if title:
+        metadata["Title"] = title
+    return metadata
+
+def extract_pdf_text(pdf_name, pdf_bytes):
+    """
+    Returns (cleaned_text, metadata), or None if extraction failed; failed PDFs are not
+    recorded in the manifest, so the next run retries them.
+    """
+    extracted = extract_text_and_metadata_hybrid(pdf_bytes, pdf_name)
+    if extracted is None:
+        logging.error(f"Failed to extract text from PDF: {pdf_name}")
         return None
+    full_text, metadata = extracted
+    cleaned_text = clean_extracted_text(full_text)
+    logging.info(f"Extracted text from {pdf_name}: {cleaned_text[:100]}...")
+    return cleaned_text, metadata
+
+def build_pdf_record(pdf_name, cleaned_text, metadata):
+    # Return a tuple with pdf_name, content, metadata (as JSON string), its paragraphs and citation fields
+    return (pdf_name, cleaned_text, json.dumps(metadata, default=str),
+            build_chunk_records(cleaned_text), build_citation(pdf_name, metadata))
 
 def clean_extracted_text(text):
-    return re.sub(r'\n+', '\n', text).strip()
+    # Single blank lines are kept: they mark the block boundaries used by build_chunk_records
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
 
 def preprocess_pdfs_to_db(limit=100):
-    pdf_list = list_blobs()[:limit]
-    logging.info(f"Processing {len(pdf_list)} PDFs")
-    batch = []
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        for result in executor.map(process_single_pdf, pdf_list):
-            if result:
-                batch.append(result)
-                if len(batch) >= 100:
-                    batch_insert_pdfs(batch)
-                    batch = []
-    if batch:
-        batch_insert_pdfs(batch)
-
-def list_blobs():
-    try:
-        return [blob.name for blob in container_client.list_blobs()]
-    except Exception as e:
-        logging.error(f"Error listing blobs: {e}")
-        return []
+    """
+    Incremental refresh: downloads and analyzes at most limit blobs that are new or changed
+    since the last run (by ETag, size and last-modified in pdf_ingest_manifest), replaces
+    their rows, and removes PDFs whose blobs were deleted from the container.
+    """
+    manifest = load_ingest_manifest()
+    listed = set()
+    summary = run_ingest_pipeline(iter_blob_properties(), manifest, limit, listed)
+    # A failed listing must never look like an empty container
+    removed = [name for name in manifest if name not in listed] if summary["listing_complete"] else []
+    if removed:
+        remove_ingested_blobs(removed)
+    if summary["stages"]["insert"]["processed"] or removed:
+        build_tfidf_index()
+        build_corpus_file()
+
+def iter_blob_properties():
+    """
+    Yields (name, etag, size, last_modified) for every blob in the container, page by page as
+    the listing arrives. Listing errors propagate to the caller.
+    """
+    for blob in container_client.list_blobs():
+        yield blob.name, blob.etag, blob.size, blob.last_modified.isoformat() if blob.last_modified else None
+
+def load_ingest_manifest():
+    """
+    Returns {blob_name: (etag, size, last_modified)} for every blob recorded in pdf_ingest_manifest.
+    """
+    with sqlite3.connect("pdf_cache.db") as conn:
+        return {
+            row[0]: tuple(row[1:])
+            for row in conn.execute("SELECT blob_name, etag, size, last_modified FROM pdf_ingest_manifest")
+        }
+
+def insert_ingested_blobs(batch):
+    # batch: [((name, etag, size, last_modified), build_pdf_record record), ...]
+    batch_insert_pdfs([record for _, record in batch], manifest=[blob for blob, _ in batch])
+
+def remove_ingested_blobs(names):
+    with sqlite3.connect("pdf_cache.db") as conn:
+        c = conn.cursor()
+        for name in names:
+            delete_pdf_rows(c, name)
+            c.execute("DELETE FROM pdf_ingest_manifest WHERE blob_name = ?", (name,))
+        bump_corpus_generation(c)
+        conn.commit()
+        logging.info(f"Removed {len(names)} PDFs deleted from the container")
+    invalidate_retrieval_caches()
 
 def download_blob(blob_name):
     try:
@@ -198,69 +581,2117 @@ def download_blob(blob_name):
         logging.error(f"Error downloading blob {blob_name}: {e}")
         return None
 
-def batch_insert_pdfs(records):
+def batch_insert_pdfs(records, manifest=()):
+    """
+    Inserts PDF records, replacing any earlier rows with the same pdf_name. manifest holds
+    (blob_name, etag, size, last_modified) entries recorded in pdf_ingest_manifest in the
+    same transaction. A record with empty content never replaces existing rows; its manifest
+    entry is left out so the blob is retried.
+    """
+    skipped = set()
     with sqlite3.connect("pdf_cache.db") as conn:
         c = conn.cursor()
+        for record in records:
+            pdf_name, content, metadata = record[:3]
+            if not content.strip() and c.execute("SELECT 1 FROM pdf_texts WHERE pdf_name = ? LIMIT 1",
+                                                 (pdf_name,)).fetchone():
+                logging.warning(f"Extracted no text from {pdf_name}, keeping its existing rows")
+                skipped.add(pdf_name)
+                continue
+            paragraphs = record[3] if len(record) > 3 else build_chunk_records(content)
+            citation = record[4] if len(record) > 4 else build_citation(pdf_name, load_metadata(metadata))
+            if delete_pdf_rows(c, pdf_name):
+                logging.info(f"Replacing existing rows of {pdf_name}")
+            c.execute('''
+                INSERT INTO pdf_texts (pdf_name, content, metadata, citation, author, year, title, publisher,
+                                       term_bloom)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (pdf_name, content, metadata, citation["citation"], citation["author"], citation["year"],
+                  citation["title"], citation["publisher"], build_term_bloom(content)))
+            index_pdf_paragraphs(c, c.lastrowid, paragraphs)
         c.executemany('''
-            INSERT INTO pdf_texts (pdf_name, content, metadata)
-            VALUES (?, ?, ?)
-        ''', records)
+            INSERT INTO pdf_ingest_manifest (blob_name, etag, size, last_modified, ingested_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(blob_name) DO UPDATE SET etag = excluded.etag, size = excluded.size,
+                last_modified = excluded.last_modified, ingested_at = excluded.ingested_at
+        ''', [tuple(blob) + (datetime.now().isoformat(),) for blob in manifest if blob[0] not in skipped])
+        bump_corpus_generation(c)
         conn.commit()
-        logging.info(f"Inserted {len(records)} PDFs into the database")
+        logging.info(f"Inserted {len(records) - len(skipped)} PDFs into the database")
+    invalidate_retrieval_caches()
+
+def index_pdf_paragraphs(c, pdf_id, paragraphs):
+    """
+    Stores the paragraphs of one PDF. Near-duplicates of an already stored paragraph are kept
+    in pdf_paragraphs with canonical_id set, but left out of the search indexes and counters,
+    so queries match only the canonical copy; load_paragraph_copies then reports the copy
+    that fits the query's metadata filters.
+    """
+    token_count = indexed = 0
+    for ordinal, text, char_start, char_end, page_number in paragraphs:
+        tokens = tokenize(text)
+        signature = minhash_signature(tokens) if len(tokens) >= MINHASH_MIN_TOKENS else None
+        canonical_id = find_near_duplicate(c, signature) if signature is not None else None
+        c.execute('''
+            INSERT INTO pdf_paragraphs (pdf_id, ordinal, text, char_start, char_end, page_number, length,
+                                        canonical_id, minhash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (pdf_id, ordinal, text, char_start, char_end, page_number, len(tokens), canonical_id,
+              None if signature is None or canonical_id is not None else signature.tobytes()))
+        if canonical_id is not None:
+            continue
+        paragraph_id = c.lastrowid
+        c.execute('INSERT INTO pdf_paragraphs_fts (rowid, text) VALUES (?, ?)', (paragraph_id, text))
+        c.execute('INSERT INTO pdf_paragraphs_trigram (rowid, text) VALUES (?, ?)', (paragraph_id, text))
+        if signature is not None:
+            c.executemany('INSERT INTO pdf_paragraph_lsh (band, bucket, paragraph_id) VALUES (?, ?, ?)',
+                          [(band, bucket, paragraph_id) for band, bucket in lsh_buckets(signature)])
+        token_count += len(tokens)
+        indexed += 1
+    add_index_stats(c, indexed, token_count, len(paragraphs) - indexed)
+    if indexed < len(paragraphs):
+        logging.info(f"Collapsed {len(paragraphs) - indexed} near-duplicate paragraphs of PDF {pdf_id}")
+
+def add_index_stats(c, paragraph_count, token_count, duplicate_count):
+    c.executemany('''
+        INSERT INTO pdf_index_stats (name, value) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+    ''', [("paragraph_count", paragraph_count), ("token_count", token_count),
+          ("duplicate_count", duplicate_count)])
+
+def delete_pdf_rows(c, pdf_name):
+    """
+    Deletes the pdf_texts rows named pdf_name with their paragraphs and search index entries.
+    Near-duplicate copies in other PDFs whose canonical paragraph is deleted are promoted:
+    the first copy is indexed in its place and the others point at it. Returns the number
+    of pdf_texts rows deleted.
+    """
+    c.execute("SELECT id FROM pdf_texts WHERE pdf_name = ?", (pdf_name,))
+    pdf_ids = [row[0] for row in c.fetchall()]
+    for pdf_id in pdf_ids:
+        c.execute("SELECT id, text, length, canonical_id FROM pdf_paragraphs WHERE pdf_id = ?", (pdf_id,))
+        paragraph_count = token_count = duplicate_count = 0
+        for paragraph_id, text, length, canonical_id in c.fetchall():
+            if canonical_id is not None:
+                duplicate_count += 1
+                continue
+            # External-content FTS5 tables need the old text to remove a row
+            c.execute("INSERT INTO pdf_paragraphs_fts (pdf_paragraphs_fts, rowid, text) VALUES ('delete', ?, ?)",
+                      (paragraph_id, text))
+            c.execute("INSERT INTO pdf_paragraphs_trigram (pdf_paragraphs_trigram, rowid, text) VALUES ('delete', ?, ?)",
+                      (paragraph_id, text))
+            paragraph_count += 1
+            token_count += length
+        add_index_stats(c, -paragraph_count, -token_count, -duplicate_count)
+        c.execute("DELETE FROM pdf_paragraph_lsh WHERE paragraph_id IN (SELECT id FROM pdf_paragraphs WHERE pdf_id = ?)",
+                  (pdf_id,))
+        c.execute('''
+            SELECT id, canonical_id, text, length FROM pdf_paragraphs
+            WHERE canonical_id IN (SELECT id FROM pdf_paragraphs WHERE pdf_id = ?) AND pdf_id != ?
+            ORDER BY id
+        ''', (pdf_id, pdf_id))
+        promoted = {}  # deleted canonical id -> id of the copy indexed in its place
+        for copy_id, canonical_id, text, length in c.fetchall():
+            if canonical_id in promoted:
+                c.execute("UPDATE pdf_paragraphs SET canonical_id = ? WHERE id = ?", (promoted[canonical_id], copy_id))
+                continue
+            promoted[canonical_id] = copy_id
+            signature = minhash_signature(tokenize(text))
+            c.execute("UPDATE pdf_paragraphs SET canonical_id = NULL, minhash = ? WHERE id = ?",
+                      (signature.tobytes(), copy_id))
+            c.execute('INSERT INTO pdf_paragraphs_fts (rowid, text) VALUES (?, ?)', (copy_id, text))
+            c.execute('INSERT INTO pdf_paragraphs_trigram (rowid, text) VALUES (?, ?)', (copy_id, text))
+            c.executemany('INSERT INTO pdf_paragraph_lsh (band, bucket, paragraph_id) VALUES (?, ?, ?)',
+                          [(band, bucket, copy_id) for band, bucket in lsh_buckets(signature)])
+            add_index_stats(c, 1, length, -1)
+        c.execute("DELETE FROM pdf_paragraphs WHERE pdf_id = ?", (pdf_id,))
+        c.execute("DELETE FROM pdf_texts WHERE id = ?", (pdf_id,))
+    return len(pdf_ids)
+
+def rebuild_pdf_search_index():
+    """
+    Rebuilds pdf_paragraphs, its full-text index, the citation columns and the term Bloom
+    filters from pdf_texts, and marks the database as PDF_CACHE_SCHEMA_VERSION.
+    init_pdf_cache_db runs it for databases built by an older version.
+    """
+    with sqlite3.connect("pdf_cache.db") as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM pdf_paragraph_lsh")
+        c.execute("DELETE FROM pdf_paragraphs")
+        c.execute("INSERT INTO pdf_paragraphs_fts (pdf_paragraphs_fts) VALUES ('delete-all')")
+        c.execute("INSERT INTO pdf_paragraphs_trigram (pdf_paragraphs_trigram) VALUES ('delete-all')")
+        c.execute("DELETE FROM pdf_index_stats WHERE name != 'generation'")
+        rows = conn.execute("SELECT id, pdf_name, content, metadata FROM pdf_texts")
+        for pdf_id, pdf_name, content, metadata in rows:
+            citation = build_citation(pdf_name, load_metadata(metadata))
+            c.execute('''
+                UPDATE pdf_texts SET citation = ?, author = ?, year = ?, title = ?, publisher = ?, term_bloom = ?
+                WHERE id = ?
+            ''', (citation["citation"], citation["author"], citation["year"], citation["title"],
+                  citation["publisher"], build_term_bloom(content), pdf_id))
+            index_pdf_paragraphs(c, pdf_id, build_chunk_records(content))
+        bump_corpus_generation(c)
+        c.execute(f"PRAGMA user_version = {PDF_CACHE_SCHEMA_VERSION}")
+        conn.commit()
+        logging.info("Rebuilt the PDF paragraph tables and search index")
+    invalidate_retrieval_caches()
+    build_tfidf_index()
+    build_corpus_file()
+
+def bump_corpus_generation(c):
+    # Every worker process compares this counter with the one its corpus cache was built from
+    c.execute('''
+        INSERT INTO pdf_index_stats (name, value) VALUES ('generation', 1)
+        ON CONFLICT(name) DO UPDATE SET value = value + 1
+    ''')
+
+def invalidate_retrieval_caches():
+    # Local invalidation; other worker processes notice the bumped generation on their next check
+    corpus_generation.invalidate()
+    corpus_cache.invalidate()
+    query_result_cache.clear()
+
+def read_corpus_generation():
+    with sqlite3.connect("pdf_cache.db") as conn:
+        row = conn.execute("SELECT value FROM pdf_index_stats WHERE name = 'generation'").fetchone()
+    return row[0] if row else 0
 
 # ---------------------
-# PDF Search & Citation Functions
+# Ingestion Pipeline
 # ---------------------
-def parse_pdf_metadata(pdf_name, metadata_json):
+INGEST_STAGES = ("list", "download", "extract", "chunk", "insert")
+
+class IngestStats:
+    """
+    Per-stage counters of one ingestion pipeline run: PDFs processed and failed, time spent
+    working, and the depth of the queue in front of the stage each time a worker takes an item.
     """
-    Instead of parsing the file name, we now use the extracted metadata if available.
-    If metadata is empty, fall back to basic parsing.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.stages = {
+            stage: {"processed": 0, "failed": 0, "busy_s": 0.0, "depth_total": 0, "depth_samples": 0, "max_depth": 0}
+            for stage in INGEST_STAGES
+        }
+
+    def record(self, stage, seconds, processed, failed, queue_depth):
+        with self._lock:
+            counters = self.stages[stage]
+            counters["processed"] += processed
+            counters["failed"] += failed
+            counters["busy_s"] += seconds
+            counters["depth_total"] += queue_depth
+            counters["depth_samples"] += 1
+            counters["max_depth"] = max(counters["max_depth"], queue_depth)
+
+    def stats(self):
+        with self._lock:
+            elapsed = time.perf_counter() - self.started
+            return {
+                "elapsed_s": round(elapsed, 3),
+                "stages": {
+                    stage: {
+                        "processed": counters["processed"],
+                        "failed": counters["failed"],
+                        "per_second": round(counters["processed"] / elapsed, 3) if elapsed else 0.0,
+                        "busy_s": round(counters["busy_s"], 3),
+                        "avg_queue_depth": round(counters["depth_total"] / (counters["depth_samples"] or 1), 2),
+                        "max_queue_depth": counters["max_depth"]
+                    }
+                    for stage, counters in self.stages.items()
+                }
+            }
+
+def log_ingest_stats(stats, prefix):
+    logging.info(prefix + "; ".join(
+        f"{stage}: {counters['processed']} done, {counters['failed']} failed, {counters['per_second']}/s, "
+        f"queue avg {counters['avg_queue_depth']} max {counters['max_queue_depth']}"
+        for stage, counters in stats["stages"].items()
+    ))
+
+def download_stage(blob):
+    pdf_bytes = download_blob(blob[0])
+    if not pdf_bytes:
+        logging.error(f"Failed to download PDF: {blob[0]}")
+        return None
+    return blob, pdf_bytes
+
+def extract_stage(item):
+    blob, pdf_bytes = item
+    extracted = extract_pdf_text(blob[0], pdf_bytes)
+    return None if extracted is None else (blob,) + extracted
+
+def chunk_stage(item):
+    blob, cleaned_text, metadata = item
+    return blob, build_pdf_record(blob[0], cleaned_text, metadata)
+
+def run_ingest_pipeline(blobs, manifest=None, limit=None, listed=None, stage_workers=None, queue_size=None,
+                        insert_batch=None):
     """
+    Runs (name, etag, size, last_modified) blobs through list -> download -> extract -> chunk
+    -> insert. The list stage consumes blobs lazily (e.g. iter_blob_properties()), adds every
+    name to the listed set if one is given, and passes on at most limit blobs that are new or
+    changed against manifest. Every stage has its own worker threads (INGEST_STAGE_WORKERS,
+    overridable per stage) and a bounded queue in front of it, so a stage that falls behind
+    blocks its producers instead of buffering whole PDFs, and one slow Form Recognizer poll
+    only holds up its own PDF. The insert stage commits whatever PDFs have finished, in
+    completion order, up to insert_batch per transaction. Returns the IngestStats summary,
+    with listing_complete False if the listing failed part way.
+    """
+    workers = dict(INGEST_STAGE_WORKERS, **(stage_workers or {}), list=1)
+    insert_batch = insert_batch or INGEST_INSERT_BATCH
+    manifest = manifest or {}
+    stats = IngestStats()
+    # queues[stage] feeds stage; a None sentinel per worker closes it
+    queues = {stage: queue.Queue(maxsize=queue_size or INGEST_QUEUE_SIZE) for stage in INGEST_STAGES[1:]}
+    remaining = {stage: workers[stage] for stage in INGEST_STAGES}
+    remaining_lock = threading.Lock()
+    listing_complete = threading.Event()
+
+    def finish(stage):
+        # The last worker of a stage to finish closes the next stage
+        with remaining_lock:
+            remaining[stage] -= 1
+            last = remaining[stage] == 0
+        if last and stage != "insert":
+            next_stage = INGEST_STAGES[INGEST_STAGES.index(stage) + 1]
+            for _ in range(workers[next_stage]):
+                queues[next_stage].put(None)
+
+    def list_worker():
+        outbox = queues["download"]
+        listed_count = queued = 0
+        try:
+            blob_iter = iter(blobs)
+            while True:
+                start = time.perf_counter()
+                blob = next(blob_iter, None)
+                if blob is None:
+                    break
+                listed_count += 1
+                if listed is not None:
+                    listed.add(blob[0])
+                changed = manifest.get(blob[0]) != tuple(blob[1:])
+                if changed and (limit is None or queued < limit):
+                    # Blocks while the download queue is full
+                    outbox.put(blob)
+                    queued += 1
+                stats.record("list", time.perf_counter() - start, 1, 0, outbox.qsize())
+            listing_complete.set()
+            logging.info(f"Listed {listed_count} blobs, {queued} new or changed queued for ingestion")
+        except Exception as e:
+            logging.error(f"Error listing blobs: {e}")
+            stats.record("list", 0.0, 0, 1, outbox.qsize())
+        finally:
+            finish("list")
+
+    def drain(stage, inbox):
+        # A worker that stopped on an unexpected error keeps taking (and dropping) items until
+        # its sentinel, so upstream stages never block on a full queue
+        dropped = 0
+        while inbox.get() is not None:
+            dropped += 1
+        if dropped:
+            logging.error(f"Ingest {stage} worker dropped {dropped} PDFs after stopping")
+
+    def stage_worker(stage, fn):
+        inbox = queues[stage]
+        outbox = queues[INGEST_STAGES[INGEST_STAGES.index(stage) + 1]]
+        try:
+            while True:
+                item = inbox.get()
+                if item is None:
+                    break
+                depth = inbox.qsize()
+                start = time.perf_counter()
+                try:
+                    result = fn(item)
+                except Exception as e:
+                    logging.error(f"Ingest {stage} stage failed: {e}")
+                    result = None
+                stats.record(stage, time.perf_counter() - start, result is not None, result is None, depth)
+                if result is not None:
+                    outbox.put(result)
+        except Exception as e:
+            logging.error(f"Ingest {stage} worker stopped: {e}")
+            drain(stage, inbox)
+        finally:
+            finish(stage)
+
+    def insert_worker():
+        inbox = queues["insert"]
+        closed = False
+        try:
+            while not closed:
+                item = inbox.get()
+                if item is None:
+                    break
+                batch = [item]
+                # Commit everything that has already finished, without waiting for more
+                while len(batch) < insert_batch:
+                    try:
+                        item = inbox.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        closed = True
+                        break
+                    batch.append(item)
+                depth = inbox.qsize()
+                start = time.perf_counter()
+                try:
+                    insert_ingested_blobs(batch)
+                    stats.record("insert", time.perf_counter() - start, len(batch), 0, depth)
+                except Exception as e:
+                    logging.error(f"Ingest insert stage failed for {len(batch)} PDFs: {e}")
+                    stats.record("insert", time.perf_counter() - start, 0, len(batch), depth)
+        except Exception as e:
+            logging.error(f"Ingest insert worker stopped: {e}")
+            if not closed:
+                drain("insert", inbox)
+        finally:
+            finish("insert")
+
+    stage_functions = {"download": download_stage, "extract": extract_stage, "chunk": chunk_stage}
+    threads = [threading.Thread(target=list_worker, daemon=True)]
+    for stage, fn in stage_functions.items():
+        threads += [threading.Thread(target=stage_worker, args=(stage, fn), daemon=True)
+                    for _ in range(workers[stage])]
+    threads += [threading.Thread(target=insert_worker, daemon=True) for _ in range(workers["insert"])]
+
+    done = threading.Event()
+    def report():
+        while not done.wait(INGEST_REPORT_INTERVAL):
+            depths = ", ".join(f"{stage} {inbox.qsize()}" for stage, inbox in queues.items())
+            log_ingest_stats(stats.stats(), f"Ingest progress (queued: {depths}): ")
+    reporter = threading.Thread(target=report, daemon=True)
+    reporter.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    done.set()
+    summary = stats.stats()
+    summary["listing_complete"] = listing_complete.is_set()
+    log_ingest_stats(summary, f"Ingested {summary['stages']['insert']['processed']} PDFs "
+                              f"in {summary['elapsed_s']}s. ")
+    return summary
+
+# ---------------------
+# PDF Search & Citation Functions
+# ---------------------
+def load_metadata(metadata_json):
     try:
-        metadata = json.loads(metadata_json) if metadata_json else {}
+        return json.loads(metadata_json) if metadata_json else {}
     except Exception:
-        metadata = {}
+        return {}
+
+def parse_year(value):
+    match = re.search(r"\b(1[5-9]\d\d|2\d\d\d)\b", str(value))
+    return int(match.group(1)) if match else None
+
+def build_citation(pdf_name, metadata):
+    """
+    Returns the structured citation fields (author, year, title, publisher) and the APA
+    citation string for a PDF. Uses the extracted metadata if available; otherwise the
+    fields are parsed from the file name (Author_Year_Title_Publisher.pdf).
+    """
+    base_name = pdf_name.rsplit('.', 1)[0]
     if metadata:
         # Example: Use fields "Author", "Title", "PublicationDate" if available.
         author = metadata.get("Author", "Unknown")
-        title = metadata.get("Title", pdf_name.rsplit('.', 1)[0])
+        title = metadata.get("Title", base_name)
         pub_date = metadata.get("PublicationDate", "n.d.")
         publisher = metadata.get("Publisher", "Unknown")
-        return f"{author} ({pub_date}). {title}. {publisher}."
     else:
-        # Fallback: Parse the filename.
-        base_name = pdf_name.rsplit('.', 1)[0]
-        parts = base_name.split('_')
-        if len(parts) >= 4:
-            return f"{parts[0]} ({parts[1]}). {parts[2]}. {parts[3]}."
-        return f"Unknown (n.d.). {base_name}. Unknown."
-
-def is_relevant(paragraph, query):
-    query_words = query.lower().split()
-    return any(word in paragraph.lower() for word in query_words)
-
-def search_pdfs_helper(user_message, max_paragraphs=5):
-    relevant_paragraphs = []
+        author, pub_date, title, publisher = (parse_citation_file_name(pdf_name)
+                                              or ("Unknown", "n.d.", base_name, "Unknown"))
+    return {
+        "citation": f"{author} ({pub_date}). {title}. {publisher}.",
+        "author": str(author),
+        "year": parse_year(pub_date),
+        "title": str(title),
+        "publisher": str(publisher)
+    }
+
+def parse_citation_file_name(pdf_name):
+    """
+    Returns (author, year, title, publisher) from an Author_Year_Title_Publisher.pdf file name,
+    or None if the name does not follow the convention.
+    """
+    parts = pdf_name.rsplit('.', 1)[0].split('_')
+    return tuple(parts[:4]) if len(parts) >= 4 else None
+
+def parse_pdf_metadata(pdf_name, metadata_json):
+    """
+    Returns the APA citation for a PDF from its metadata JSON, falling back to the file name.
+    Retrieval reads the precomputed pdf_texts.citation column instead.
+    """
+    return build_citation(pdf_name, load_metadata(metadata_json))["citation"]
+
+def build_paragraph_records(content):
+    """
+    Splits content into (ordinal, text, char_start, char_end, page_number) tuples.
+    Offsets index into content; pages are counted from the form feeds between them.
+    """
+    records = []
+    page_number = 1
+    position = 0
+    for line in content.split("\n"):
+        page_number += line.count("\f")
+        text = line.strip()
+        if text:
+            char_start = position + line.index(text)
+            records.append((len(records), text, char_start, char_start + len(text), page_number))
+        position += len(line) + 1
+    return records
+
+HEADING_NUMBERING = re.compile(r"^(?:\d+(?:\.\d+)*\.?|[IVX]+\.)\s+[A-Z]")
+SECTION_NAMES = frozenset(
+    "abstract introduction background methods materials results discussion conclusion conclusions "
+    "references summary examples claims acknowledgements acknowledgments".split()
+)
+
+def looks_like_heading(line, standalone=False):
+    """
+    Numbered or all-caps short lines and common section names are headings; so is any short
+    standalone block without closing punctuation, which is how layout headings are extracted.
+    """
+    if len(line) > 80 or len(line.split()) > 10 or line[-1] in ".,;":
+        return False
+    if HEADING_NUMBERING.match(line) or line.lower().rstrip(" :") in SECTION_NAMES:
+        return True
+    letters = [ch for ch in line if ch.isalpha()]
+    if len(letters) >= 3 and all(ch.isupper() for ch in letters):
+        return True
+    return standalone and line[-1] != ":"
+
+def build_chunk_records(content, max_chars=None, min_chars=None, overlap_chars=None):
+    """
+    Merges the lines of content into size-bounded chunks, returned as the same
+    (ordinal, text, char_start, char_end, page_number) tuples as build_paragraph_records.
+    Headings start a new chunk, blank lines and page breaks end one once it holds min_chars,
+    and a chunk that would pass max_chars is split with up to overlap_chars of trailing lines
+    repeated at the start of the next. Chunk text joins its lines with newlines; the offsets
+    span it in content and page_number is the page of its first line.
+    """
+    max_chars = CHUNK_MAX_CHARS if max_chars is None else max_chars
+    min_chars = CHUNK_MIN_CHARS if min_chars is None else min_chars
+    overlap_chars = CHUNK_OVERLAP_CHARS if overlap_chars is None else overlap_chars
+    if max_chars <= 0:
+        return build_paragraph_records(content)
+
+    lines = []  # (text, char_start, char_end, page_number, starts_block)
+    starts_block = True
+    for _, text, char_start, char_end, page_number in build_paragraph_records(content):
+        # A skipped blank line or a form feed between two lines marks a block boundary
+        gap = content[lines[-1][2]:char_start] if lines else ""
+        if gap.count("\n") > 1 or "\f" in gap:
+            starts_block = True
+        lines.append((text, char_start, char_end, page_number, starts_block))
+        starts_block = False
+
+    records = []
+    current, size, has_body = [], 0, False
+
+    def flush():
+        records.append((len(records), "\n".join(line[0] for line in current), current[0][1], current[-1][2],
+                        current[0][3]))
+
+    for index, line in enumerate(lines):
+        text, starts_block = line[0], line[4]
+        standalone = starts_block and (index + 1 == len(lines) or lines[index + 1][4])
+        heading = looks_like_heading(text, standalone)
+        if current and ((heading and has_body) or (starts_block and size >= min_chars)):
+            flush()
+            current, size, has_body = [], 0, False
+        elif current and size + 1 + len(text) > max_chars:
+            flush()
+            tail, tail_size = [], 0
+            # Always leave at least one line behind so every chunk makes progress
+            for previous in reversed(current[1:]):
+                if tail_size + len(previous[0]) + 1 > overlap_chars:
+                    break
+                tail.insert(0, previous)
+                tail_size += len(previous[0]) + 1
+            current, size, has_body = tail, tail_size, bool(tail)
+        current.append(line)
+        size += len(text) + 1
+        has_body = has_body or not heading
+    if current:
+        flush()
+    return records
+
+def tokenize(text):
+    # Mirrors the FTS5 unicode61 tokenizer: lowercase runs of letters and digits
+    return re.findall(r"[^\W_]+", text.lower())
+
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were what "
+    "which with how does do can i we you".split()
+)
+
+WORD_CHARACTER = re.compile(r"[^\W_]")
+
+class QueryMatcher:
+    """
+    Matches every term of a query against a paragraph with one precompiled regex, instead of
+    one lowercase-and-search per query word. By default terms are whitespace-separated query
+    words matched as case-insensitive substrings; whole_words restricts hits to whole tokens
+    and drop_stopwords ignores common English words.
+    """
+    def __init__(self, terms, whole_words=False, drop_stopwords=False):
+        terms = [term.lower() for term in terms if term]
+        if drop_stopwords:
+            terms = [term for term in terms if term not in STOPWORDS]
+        # Longest first, so at any position the alternation reports the longest term
+        self.terms = sorted(dict.fromkeys(terms), key=len, reverse=True)
+        self.whole_words = whole_words
+        alternation = "|".join(map(re.escape, self.terms))
+        if whole_words:
+            alternation = r"(?<![^\W_])(?:" + alternation + r")(?![^\W_])"
+        self.pattern = re.compile(alternation, re.IGNORECASE) if self.terms else None
+        # Zero-width lookahead variant reports a hit at every position, so hits may overlap
+        self._overlapping = re.compile(f"(?=({alternation}))", re.IGNORECASE) if self.terms else None
+
+    def matches(self, paragraph):
+        return self.pattern is not None and self.pattern.search(paragraph) is not None
+
+    def matched_terms(self, paragraph):
+        """
+        Returns the set of terms that occur in paragraph, found in one pass. At each position
+        the pattern reports the longest matching term; any other term matching there is a
+        prefix of it, and with whole_words only one that ends at a token boundary.
+        """
+        if self._overlapping is None:
+            return set()
+        matched = set()
+        for hit in {match.group(1).lower() for match in self._overlapping.finditer(paragraph)}:
+            matched.update(
+                term for term in self.terms
+                if hit.startswith(term) and (not self.whole_words or len(term) == len(hit)
+                                             or not WORD_CHARACTER.match(hit, len(term)))
+            )
+        return matched
+
+class PhraseMatcher:
+    """
+    Matches paragraphs that contain every phrase, each given as its tokens and matched as a
+    case-insensitive substring in which anything but letters and digits may separate the
+    tokens, as between consecutive FTS5 tokens.
+    """
+    def __init__(self, phrases):
+        self.patterns = [re.compile(r"[\W_]+".join(map(re.escape, tokens)), re.IGNORECASE) for tokens in phrases]
+
+    def matches(self, paragraph):
+        return all(pattern.search(paragraph) for pattern in self.patterns)
+
+@lru_cache(maxsize=256)
+def query_matcher(query):
+    """
+    Paragraph matcher for the pdf_texts scan, reading the query like parse_search_query: every
+    phrase and NEAR operand must occur (NEAR distances are not checked); without any, one of
+    the query words must occur as a case-insensitive substring.
+    """
+    constraints, terms = parse_query_constraints(query)
+    operands = [tokens for group, _ in constraints for tokens in group]
+    return PhraseMatcher(operands) if operands else QueryMatcher(terms)
+
+QUERY_SYNTAX = re.compile(r'"([^"]*)"|(?<!\S)NEAR(?:/(\d+))?(?!\S)|([^\s"]+)')
+
+def parse_query_constraints(user_message):
+    """
+    Splits a query into required positional constraints and plain words. Supported syntax:
+    "quoted phrases" and proximity written as `a NEAR/k b` (also chained, `a NEAR/k b NEAR/k c`),
+    where operands are words or quoted phrases and k defaults to NEAR_DEFAULT_DISTANCE.
+    Returns (constraints, terms): (operands, distance) pairs, where operands are token lists and
+    distance is None for a lone phrase, and every query token.
+    """
+    items = []
+    for match in QUERY_SYNTAX.finditer(user_message):
+        phrase, distance, word = match.groups()
+        if phrase is not None:
+            items.append(("phrase", tokenize(phrase)))
+        elif word is not None:
+            items.append(("word", tokenize(word)))
+        else:
+            items.append(("near", int(distance) if distance else NEAR_DEFAULT_DISTANCE))
+    items = [item for item in items if item[1]]
+
+    constraints = []
+    terms = [token for kind, value in items if kind != "near" for token in value]
+    i = 0
+    while i < len(items):
+        kind, value = items[i]
+        if kind == "near":
+            i += 1
+            continue
+        group, distance = [value], None
+        while i + 2 < len(items) and items[i + 1][0] == "near" and items[i + 2][0] != "near":
+            distance = max(distance or 0, items[i + 1][1])
+            group.append(items[i + 2][1])
+            i += 2
+        i += 1
+        if distance is not None:
+            constraints.append((group, distance))
+        elif kind == "phrase":
+            constraints.append(([value], None))
+    return constraints, terms
+
+def parse_search_query(user_message):
+    """
+    parse_query_constraints with the constraints written as FTS5 expressions (phrases and
+    NEAR groups) that must all match. Returns (constraints, terms).
+    """
+    constraints, terms = parse_query_constraints(user_message)
+    expressions = []
+    for operands, distance in constraints:
+        phrases = " ".join('"' + " ".join(tokens) + '"' for tokens in operands)
+        expressions.append(phrases if distance is None else f"NEAR({phrases}, {distance})")
+    return expressions, terms
+
+def build_fts_query(user_message):
+    """
+    Turns a question into an FTS5 MATCH expression. Phrases and NEAR constraints (see
+    parse_search_query) are all required and answered from FTS5's positional postings;
+    without them the expression matches any of the words. Words are always quoted so
+    punctuation and FTS5 keywords are taken literally.
+    """
+    constraints, terms = parse_search_query(user_message)
+    if constraints:
+        return " AND ".join(constraints)
+    return " OR ".join(f'"{word}"' for word in dict.fromkeys(terms))
+
+METADATA_TEXT_COLUMNS = ("author", "title", "publisher")
+METADATA_FILTER_SYNTAX = re.compile(r"^\s*(author|year|title|publisher)\s*(>=|<=|!=|=|>|<)\s*(.*?)\s*$", re.IGNORECASE)
+
+def parse_metadata_filters(filters):
+    """
+    Parses filters such as "year>=2018" or "publisher=Elsevier" on the indexed pdf_texts
+    citation columns into a tuple of (column, operator, value). Values may be quoted;
+    year values must be integers. Raises ValueError for anything else.
+    """
+    parsed = []
+    for text in filters or ():
+        match = METADATA_FILTER_SYNTAX.match(text)
+        if not match or not match.group(3):
+            raise ValueError(f"Invalid filter '{text}'; expected e.g. year>=2018 or publisher=Elsevier")
+        column, operator, value = match.group(1).lower(), match.group(2), match.group(3)
+        if len(value) > 1 and value[0] == value[-1] and value[0] in "\"'":
+            value = value[1:-1]
+        if column == "year":
+            try:
+                value = int(value)
+            except ValueError:
+                raise ValueError(f"Invalid filter '{text}'; year must be an integer")
+        parsed.append((column, operator, value))
+    return tuple(parsed)
+
+def metadata_filter_sql(filters):
+    """
+    Returns (where, params) for parsed filters, used as
+    pdf_id IN (SELECT id FROM pdf_texts WHERE <where>) so SQLite selects the matching
+    PDFs through the column indexes. where is empty when there are no filters. Author, title
+    and publisher compare case-insensitively.
+    """
+    return " AND ".join(
+        f"{column} {operator} ?" + (" COLLATE NOCASE" if column in METADATA_TEXT_COLUMNS else "")
+        for column, operator, _ in filters
+    ), [value for _, _, value in filters]
+
+def paragraph_filter_sql(rowid_column, where):
+    # Restricts a full-text table's rowids (canonical paragraph ids) to paragraphs with a copy,
+    # canonical or near-duplicate, in the PDFs selected by where
+    if not where:
+        return ""
+    return (f"AND {rowid_column} IN (SELECT COALESCE(d.canonical_id, d.id) FROM pdf_paragraphs d "
+            f"WHERE d.pdf_id IN (SELECT id FROM pdf_texts WHERE {where}))")
+
+def bm25_score(term_counts, length, doc_freqs, paragraph_count, avg_length):
+    score = 0.0
+    for term, doc_freq in doc_freqs.items():
+        tf = term_counts.get(term, 0)
+        if not tf:
+            continue
+        idf = math.log(1 + (paragraph_count - doc_freq + 0.5) / (doc_freq + 0.5))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+        score += idf * tf * (BM25_K1 + 1) / (tf + norm)
+    return score
+
+def push_top_k(heap, k, score, seq, item):
+    """
+    Keeps the k best (score, item) pairs in a min-heap; ties favour the earlier seq.
+    """
+    entry = (score, -seq, item)
+    if len(heap) < k:
+        heapq.heappush(heap, entry)
+    elif entry[:2] > heap[0][:2]:
+        heapq.heapreplace(heap, entry)
+
+def load_bm25_stats(c, terms):
+    c.execute("SELECT name, value FROM pdf_index_stats")
+    stats = dict(c.fetchall())
+    paragraph_count = stats.get("paragraph_count", 0)
+    avg_length = stats.get("token_count", 0) / paragraph_count if paragraph_count else 1.0
+    placeholders = ",".join("?" * len(terms))
+    c.execute(f"SELECT term, doc FROM pdf_paragraphs_vocab WHERE term IN ({placeholders})", terms)
+    return dict(c.fetchall()), paragraph_count, avg_length or 1.0
+
+def search_pdfs_helper(user_message, max_paragraphs=5, ranked=True, retriever=None, filters=None, rerank=True):
+    """
+    Returns up to max_paragraphs paragraphs matching any word of user_message, served from
+    query_result_cache when the same normalized query was answered for the current corpus.
+    filters (e.g. ["year>=2018", "publisher=Elsevier"]) restrict the search to matching PDFs;
+    see parse_metadata_filters. Ranked searches go through two_stage_search unless rerank is
+    False or RERANK_CANDIDATES is 0.
+    """
+    retriever = retriever or PDF_RETRIEVER
+    filters = parse_metadata_filters(filters)
+    rerank = ranked and rerank and RERANK_CANDIDATES > 0
+    constraints, terms = parse_search_query(user_message)
+    key = query_cache_key(constraints, terms, filters, max_paragraphs, ranked, retriever, rerank)
+    generation = corpus_generation.current()
+    results = query_result_cache.get(key, generation)
+    if results is None:
+        if rerank:
+            results, degraded = two_stage_search(user_message, max_paragraphs, retriever, filters)
+        else:
+            results, degraded = retrieve_pdf_paragraphs_checked(user_message, max_paragraphs, ranked, retriever,
+                                                                filters)
+        # A fallback answer is served once, but the next request tries the real index again
+        if not degraded:
+            query_result_cache.put(key, generation, results)
+    # Callers may annotate the dicts, so never hand out the cached ones
+    return [dict(result) for result in results]
+
+def search_pdfs_batch_helper(queries, max_paragraphs=5, rerank=True):
+    """
+    Returns one list of BM25-ranked paragraphs per query, in query order. Cached answers are
+    reused and repeated queries answered once; the remaining plain-word queries share a single
+    pass over the full-text matches of all their words, so each paragraph is read and tokenized
+    once per batch instead of once per query. Phrase and NEAR queries are answered one by one.
+    Like search_pdfs_helper, the shared pass fetches RERANK_CANDIDATES per query for reranking.
+    """
+    rerank = rerank and RERANK_CANDIDATES > 0
+    generation = corpus_generation.current()
+    results = [None] * len(queries)
+    pending = OrderedDict()  # cache key -> (query, terms, positions in queries)
+    for position, query in enumerate(queries):
+        constraints, terms = parse_search_query(query)
+        key = query_cache_key(constraints, terms, (), max_paragraphs, True, "bm25", rerank)
+        if key in pending:
+            pending[key][2].append(position)
+            continue
+        cached = query_result_cache.get(key, generation)
+        if cached is not None:
+            results[position] = cached
+        elif constraints or not terms:
+            if rerank:
+                results[position], degraded = two_stage_search(query, max_paragraphs, "bm25")
+            else:
+                results[position], degraded = retrieve_pdf_paragraphs_checked(query, max_paragraphs, retriever="bm25")
+            if not degraded:
+                query_result_cache.put(key, generation, results[position])
+        else:
+            pending[key] = (query, terms, [position])
+    if pending:
+        batch = [(query, terms) for query, terms, _ in pending.values()]
+        start = time.perf_counter()
+        candidates = rank_batch_matches(batch, max(RERANK_CANDIDATES, max_paragraphs) if rerank else max_paragraphs)
+        stage1_ms = (time.perf_counter() - start) * 1000 / len(batch)
+        for (key, (query, _, positions)), (ranked, degraded) in zip(pending.items(), candidates):
+            if rerank:
+                ranked = timed_rerank(query, ranked, max_paragraphs, stage1_ms)
+            if not degraded:
+                query_result_cache.put(key, generation, ranked)
+            for position in positions:
+                results[position] = ranked
+    logging.info(f"Answered {len(queries)} queries in one batch ({len(pending)} in the shared pass)")
+    return [[dict(result) for result in ranked] for ranked in results]
+
+def query_cache_key(constraints, terms, filters, max_paragraphs, ranked, retriever, rerank):
+    # Term counts, not just the set of terms: TF-IDF weights repeated query words
+    return (tuple(constraints), tuple(sorted(Counter(terms).items())), tuple(sorted(filters, key=repr)), max_paragraphs,
+            ranked, retriever, rerank)
+
+def rank_batch_matches(batch, max_paragraphs):
+    """
+    BM25 top-k for each (query, terms) in batch, as (results, degraded) pairs like
+    retrieve_pdf_paragraphs_checked. Uses the corpus cache when it is loaded; otherwise runs
+    one full-text query for the union of all terms and scores every matching paragraph for
+    each query that shares a word with it. Queries containing a word above BATCH_UNION_MAX_DF
+    are answered on their own, and matches are streamed from the cursor.
+    """
+    corpus = corpus_cache.get()
+    if corpus is not None:
+        return [(corpus.search(terms, max_paragraphs), False) for _, terms in batch]
     try:
         with sqlite3.connect("pdf_cache.db") as conn:
             c = conn.cursor()
-            c.execute("SELECT pdf_name, content, metadata FROM pdf_texts")
-            pdfs = [{"name": row[0], "content": row[1], "metadata": row[2]} for row in c.fetchall()]
+            all_terms = list(dict.fromkeys(term for _, terms in batch for term in terms))
+            doc_freqs, paragraph_count, avg_length = load_bm25_stats(c, all_terms)
+            query_freqs = [{term: doc_freqs[term] for term in terms if term in doc_freqs} for _, terms in batch]
+            common = {term for term, doc_freq in doc_freqs.items() if doc_freq > BATCH_UNION_MAX_DF * paragraph_count}
+            separate = {index for index, freqs in enumerate(query_freqs) if common.intersection(freqs)}
+            term_queries = {}  # term -> indexes into batch
+            for index, freqs in enumerate(query_freqs):
+                if index not in separate:
+                    for term in freqs:
+                        term_queries.setdefault(term, []).append(index)
+            heaps = [[] for _ in batch]
+            if term_queries:
+                c.execute('''
+                    SELECT p.id, p.text, p.length
+                    FROM pdf_paragraphs_fts f
+                    JOIN pdf_paragraphs p ON p.id = f.rowid
+                    WHERE pdf_paragraphs_fts MATCH ?
+                ''', (" OR ".join(f'"{term}"' for term in term_queries),))
+                for paragraph_id, paragraph, length in c:
+                    term_counts = {}
+                    for token in tokenize(paragraph):
+                        if token in term_queries:
+                            term_counts[token] = term_counts.get(token, 0) + 1
+                    for index in {index for term in term_counts for index in term_queries[term]}:
+                        score = bm25_score(term_counts, length, query_freqs[index], paragraph_count, avg_length)
+                        push_top_k(heaps[index], max_paragraphs, score, paragraph_id, paragraph_id)
+            answers = []
+            for index, heap in enumerate(heaps):
+                if index in separate:
+                    answers.append(retrieve_pdf_paragraphs_checked(batch[index][0], max_paragraphs, retriever="bm25"))
+                else:
+                    scored_ids = [(paragraph_id, score) for score, _, paragraph_id in sorted(heap, reverse=True)]
+                    answers.append((load_paragraph_results(c, scored_ids), False))
+            return answers
+    except sqlite3.OperationalError as e:
+        logging.warning(f"PDF search index unavailable, answering the batch one query at a time: {e}")
+    return [retrieve_pdf_paragraphs_checked(query, max_paragraphs, retriever="bm25") for query, _ in batch]
+
+def retrieve_pdf_paragraphs(user_message, max_paragraphs=5, ranked=True, retriever=None, filters=()):
+    """
+    retrieve_pdf_paragraphs_checked without the degraded flag.
+    """
+    return retrieve_pdf_paragraphs_checked(user_message, max_paragraphs, ranked, retriever, filters)[0]
+
+def retrieve_pdf_paragraphs_checked(user_message, max_paragraphs=5, ranked=True, retriever=None, filters=()):
+    """
+    Returns up to max_paragraphs paragraphs matching any word of user_message.
+    Uses the paragraph full-text index so the cost follows the matching postings;
+    falls back to scanning pdf_texts when the index is not available.
+    With ranked=True the matches are scored with BM25 and the best ones are returned,
+    highest score first, each with a "score" key; otherwise the first matches are returned.
+    retriever (default PDF_RETRIEVER) selects "tfidf" for cosine similarity over hashed TF-IDF vectors,
+    or "sharded" to split ranked BM25 scoring of the full-text matches across worker processes.
+    Queries with phrases or NEAR constraints always go to the full-text index, which holds
+    the positional postings needed to check them. So do queries with (parsed) metadata filters,
+    which select the matching PDFs through the pdf_texts column indexes before any scoring.
+    Returns (results, degraded); degraded is True when an error or a missing or stale index
+    forced a fallback (BM25 for TF-IDF, the pdf_texts scan, or no results), and such answers
+    are never cached.
+    """
+    fts_query = build_fts_query(user_message)
+    if not fts_query:
+        return [], False
+    retriever = retriever or PDF_RETRIEVER
+    constraints, terms = parse_search_query(user_message)
+    if not constraints and not filters and retriever == "tfidf":
+        index = load_tfidf_index()
+        # While preprocess_pdfs_to_db rebuilds the index after a corpus change, answering from
+        # the old one would cache stale results under the new generation
+        if index is not None and index["generation"] == corpus_generation.current():
+            return search_tfidf_index(index, user_message, max_paragraphs), False
+        logging.warning("TF-IDF index not available or not built for the current corpus; using the BM25 retriever")
+        return retrieve_pdf_paragraphs_checked(user_message, max_paragraphs, ranked, "bm25", filters)[0], True
+    sharded = ranked and retriever == "sharded"
+    corpus = corpus_cache.get() if not constraints and not filters and not sharded else None
+    if corpus is not None:
+        return corpus.search(terms, max_paragraphs, ranked), False
+    try:
+        with sqlite3.connect("pdf_cache.db") as conn:
+            c = conn.cursor()
+            if not ranked:
+                where, params = metadata_filter_sql(filters)
+                c.execute(f'''
+                    SELECT f.rowid
+                    FROM pdf_paragraphs_fts f
+                    WHERE pdf_paragraphs_fts MATCH ? {paragraph_filter_sql("f.rowid", where)}
+                    LIMIT ?
+                ''', [fts_query] + params + [max_paragraphs])
+                paragraph_ids = [row[0] for row in c.fetchall()]
+                paragraphs = load_paragraph_copies(c, paragraph_ids, filters)
+                return [
+                    {"paragraph": paragraphs[paragraph_id][0], "source": paragraphs[paragraph_id][2],
+                     "pdf_name": paragraphs[paragraph_id][1], "page_number": paragraphs[paragraph_id][3]}
+                    for paragraph_id in paragraph_ids if paragraph_id in paragraphs
+                ], False
+            if sharded:
+                return rank_fts_matches_sharded(c, fts_query, terms, max_paragraphs, filters=filters), False
+            return rank_fts_matches(c, fts_query, terms, max_paragraphs, filters), False
+    except sqlite3.OperationalError as e:
+        logging.warning(f"PDF search index unavailable, scanning pdf_texts instead: {e}")
+    except Exception as e:
+        logging.error(f"Error searching PDF index: {e}")
+        return [], True
+    return scan_pdfs_helper(user_message, max_paragraphs, filters), True
+
+def rank_fts_matches(c, fts_query, query_terms, max_paragraphs, filters=()):
+    bm25_stats = load_bm25_stats(c, list(dict.fromkeys(query_terms)))
+    heap = top_k_fts_matches(c, fts_query, bm25_stats, max_paragraphs, filters=filters)
+    return load_paragraph_results(c, [(paragraph_id, score) for score, _, paragraph_id in sorted(heap, reverse=True)],
+                                  filters)
+
+def top_k_fts_matches(c, fts_query, bm25_stats, k, rowid_range=None, filters=()):
+    """
+    Scores the full-text matches of fts_query with BM25 and returns the push_top_k heap of
+    the k best, optionally limited to paragraph ids within rowid_range (inclusive) and to
+    PDFs matching parsed metadata filters.
+    """
+    doc_freqs, paragraph_count, avg_length = bm25_stats
+    heap = []
+    sql = '''
+        SELECT p.id, p.text, p.length
+        FROM pdf_paragraphs_fts f
+        JOIN pdf_paragraphs p ON p.id = f.rowid
+        WHERE pdf_paragraphs_fts MATCH ?
+    '''
+    params = (fts_query,)
+    if rowid_range is not None:
+        sql += " AND f.rowid BETWEEN ? AND ?"
+        params += tuple(rowid_range)
+    where, filter_params = metadata_filter_sql(filters)
+    if where:
+        sql += " " + paragraph_filter_sql("f.rowid", where)
+        params += tuple(filter_params)
+    c.execute(sql, params)
+    for paragraph_id, paragraph, length in c:
+        term_counts = {}
+        for token in tokenize(paragraph):
+            if token in doc_freqs:
+                term_counts[token] = term_counts.get(token, 0) + 1
+        score = bm25_score(term_counts, length, doc_freqs, paragraph_count, avg_length)
+        push_top_k(heap, k, score, paragraph_id, paragraph_id)
+    return heap
+
+def load_paragraph_results(c, scored_ids, filters=()):
+    """
+    Resolves [(paragraph_id, score), ...] into result dicts, keeping the given order; each
+    result cites the copy of the paragraph chosen by load_paragraph_copies for the parsed
+    metadata filters. Unfiltered results are read from the memory-mapped corpus file when it
+    matches the current corpus.
+    """
+    if not scored_ids:
+        return []
+    corpus_file = mapped_corpus() if not filters else None
+    if corpus_file is not None:
+        return corpus_file.load_results(scored_ids)
+    paragraphs = load_paragraph_copies(c, [paragraph_id for paragraph_id, _ in scored_ids], filters)
+    return [
+        {
+            "paragraph": paragraphs[paragraph_id][0],
+            "source": paragraphs[paragraph_id][2],
+            "pdf_name": paragraphs[paragraph_id][1],
+            "page_number": paragraphs[paragraph_id][3],
+            "score": round(score, 4)
+        }
+        for paragraph_id, score in scored_ids if paragraph_id in paragraphs
+    ]
+
+def build_snippet(text, pattern, width=SNIPPET_CHARS):
+    """
+    Cuts a window of about width characters around the first match of pattern in text and
+    returns (snippet, highlights) where highlights are [start, end] offsets into the snippet.
+    """
+    first = pattern.search(text)
+    start = 0
+    if first and len(text) > width:
+        start = max(0, min(first.start() - width // 4, len(text) - width))
+    snippet = text[start:start + width]
+    highlights = [[m.start(), m.end()] for m in pattern.finditer(snippet)]
+    return snippet, highlights
+
+def search_pdfs_page(search_term, page=1, page_size=SEARCH_PAGE_SIZE_DEFAULT, filters=()):
+    """
+    Ranked, paginated paragraph search over the full-text index, optionally restricted to PDFs
+    matching parsed metadata filters. Returns the total number of matching paragraphs and one
+    page of results with snippets, highlight offsets and citations.
+    """
+    fts_query = build_fts_query(search_term)
+    if not fts_query:
+        return {"total": 0, "results": []}
+    # Highlight the query's words and phrase words, not NEAR/k operators
+    _, terms = parse_search_query(search_term)
+    pattern = QueryMatcher(terms, whole_words=True).pattern
+    where, params = metadata_filter_sql(filters)
+    filter_sql = paragraph_filter_sql("f.rowid", where)
+    with sqlite3.connect("pdf_cache.db") as conn:
+        c = conn.cursor()
+        c.execute(f"SELECT COUNT(*) FROM pdf_paragraphs_fts f WHERE pdf_paragraphs_fts MATCH ? {filter_sql}",
+                  [fts_query] + params)
+        total = c.fetchone()[0]
+        c.execute(f'''
+            SELECT f.rowid, -f.rank
+            FROM pdf_paragraphs_fts f
+            WHERE pdf_paragraphs_fts MATCH ? {filter_sql}
+            ORDER BY f.rank
+            LIMIT ? OFFSET ?
+        ''', [fts_query] + params + [page_size, (page - 1) * page_size])
+        rows = c.fetchall()
+        paragraphs = load_paragraph_copies(c, [paragraph_id for paragraph_id, _ in rows], filters)
+    results = []
+    for paragraph_id, score in rows:
+        if paragraph_id not in paragraphs:
+            continue
+        text, pdf_name, citation, page_number = paragraphs[paragraph_id]
+        snippet, highlights = build_snippet(text, pattern)
+        results.append({
+            "paragraph_id": paragraph_id,
+            "pdf_name": pdf_name,
+            "citation": citation,
+            "page_number": page_number,
+            "snippet": snippet,
+            "highlights": highlights,
+            "score": round(score, 6)
+        })
+    return {"total": total, "results": results}
+
+def casefold_text(text):
+    # SQL function for search_pdfs_substring: SQLite's lower() only folds ASCII letters
+    return text.casefold() if text is not None else None
+
+def search_pdfs_substring(search_term, page=1, page_size=SEARCH_PAGE_SIZE_DEFAULT, filters=()):
+    """
+    Case-insensitive substring search (the old LIKE '%term%' semantics, e.g. partial chemical
+    names or part numbers) answered from the trigram index. Terms of three or more characters
+    are index probes; shorter ones make FTS5 scan. Results are in document order.
+    """
+    needle = search_term.strip()
+    if not needle:
+        return {"total": 0, "results": []}
+    # LIKE drives the trigram lookup ('%' and '_' inside the term only widen it), but it only
+    # folds ASCII case; non-ASCII terms use a trigram phrase MATCH, which folds Unicode case.
+    # instr() over the Python-casefolded text then keeps exact substring matches only
+    filter_where, filter_params = metadata_filter_sql(filters)
+    if needle.isascii():
+        lookup, lookup_params = "g.text LIKE ? AND ", (f"%{needle}%",)
+    elif len(needle) >= 3:
+        lookup, lookup_params = "pdf_paragraphs_trigram MATCH ? AND ", ('"' + needle.replace('"', '""') + '"',)
+    else:
+        lookup, lookup_params = "", ()
+    params = (*lookup_params, needle.casefold(), *filter_params)
+    where = lookup + "instr(casefold(g.text), ?) > 0 " + paragraph_filter_sql("g.rowid", filter_where)
+    with sqlite3.connect("pdf_cache.db") as conn:
+        conn.create_function("casefold", 1, casefold_text, deterministic=True)
+        c = conn.cursor()
+        c.execute(f"SELECT COUNT(*) FROM pdf_paragraphs_trigram g WHERE {where}", params)
+        total = c.fetchone()[0]
+        c.execute(f'''
+            SELECT g.rowid
+            FROM pdf_paragraphs_trigram g
+            WHERE {where}
+            ORDER BY g.rowid
+            LIMIT ? OFFSET ?
+        ''', params + (page_size, (page - 1) * page_size))
+        paragraph_ids = [row[0] for row in c.fetchall()]
+        paragraphs = load_paragraph_copies(c, paragraph_ids, filters)
+    pattern = re.compile(re.escape(needle), re.IGNORECASE)
+    results = []
+    for paragraph_id in paragraph_ids:
+        if paragraph_id not in paragraphs:
+            continue
+        text, pdf_name, citation, page_number = paragraphs[paragraph_id]
+        snippet, highlights = build_snippet(text, pattern)
+        results.append({
+            "paragraph_id": paragraph_id,
+            "pdf_name": pdf_name,
+            "citation": citation,
+            "page_number": page_number,
+            "snippet": snippet,
+            "highlights": highlights
+        })
+    return {"total": total, "results": results}
+
+def scan_pdfs_helper(user_message, max_paragraphs=5, filters=()):
+    """
+    Unranked scan of pdf_texts that streams rows from the cursor and stops as soon as
+    max_paragraphs hits are found, so peak memory is bounded by the largest document.
+    Paragraphs are matched with query_matcher, so phrases and NEAR operands are required as
+    in the full-text index. Documents whose term Bloom filter rules the query out are skipped unread.
+    """
+    try:
+        with sqlite3.connect("pdf_cache.db") as conn:
+            rows = iter_candidate_documents(conn, user_message, filters)
+            return list(islice(iter_relevant_paragraphs(rows, user_message), max_paragraphs))
     except Exception as e:
         logging.error(f"Error retrieving PDFs from cache: {e}")
-        return relevant_paragraphs
-
-    for pdf in pdfs:
-        citation = parse_pdf_metadata(pdf["name"], pdf["metadata"])
-        paragraphs = [p.strip() for p in pdf["content"].split("\n") if p.strip()]
-        for paragraph in paragraphs:
-            if is_relevant(paragraph, user_message):
-                relevant_paragraphs.append({
+        return []
+
+def iter_candidate_documents(conn, user_message, filters=()):
+    """
+    Yields (pdf_name, content, metadata, citation) for the pdf_texts rows that match the parsed
+    metadata filters and may match the query (see bloom_query_probes). content is fetched separately, so skipped
+    documents are never read or split.
+    """
+    probes = bloom_query_probes(user_message)
+    where, params = metadata_filter_sql(filters)
+    checked = skipped = 0
+    try:
+        rows = conn.execute(
+            f"SELECT id, pdf_name, metadata, citation, term_bloom FROM pdf_texts "
+            f"{'WHERE ' + where if where else ''} ORDER BY id",
+            params
+        )
+        for pdf_id, pdf_name, metadata, citation, term_bloom in rows:
+            checked += 1
+            if not bloom_may_match(term_bloom, probes):
+                skipped += 1
+                continue
+            content = conn.execute("SELECT content FROM pdf_texts WHERE id = ?", (pdf_id,)).fetchone()[0]
+            yield pdf_name, content, metadata, citation
+    finally:
+        bloom_scan_stats.record(checked, skipped)
+        if checked:
+            logging.info(f"Term Bloom filters skipped {skipped}/{checked} documents for '{user_message}'")
+
+def iter_paragraphs(content):
+    # Non-empty stripped lines, yielded lazily: no per-document list of lines is built
+    for match in re.finditer(r"[^\n]+", content):
+        paragraph = match.group().strip()
+        if paragraph:
+            yield paragraph
+
+def iter_relevant_paragraphs(rows, user_message):
+    """
+    Yields result dicts for matching paragraphs from (pdf_name, content, metadata, citation) rows.
+    """
+    matcher = query_matcher(user_message)
+    seen = set()
+    for pdf_name, content, metadata, citation in rows:
+        citation = citation or parse_pdf_metadata(pdf_name, metadata)
+        for paragraph in iter_paragraphs(content):
+            if matcher.matches(paragraph):
+                # The scan reads raw pdf_texts, so repeated copies of a paragraph are collapsed here
+                key = " ".join(tokenize(paragraph))
+                if key in seen:
+                    continue
+                seen.add(key)
+                yield {
                     "paragraph": paragraph,
                     "source": citation,
-                    "pdf_name": pdf["name"]
-                })
-    return relevant_paragraphs[:max_paragraphs]
+                    "pdf_name": pdf_name
+                }
+
+# ---------------------
+# Near-Duplicate Detection
+# ---------------------
+_minhash_rng = np.random.default_rng(20240601)
+# Multiply-shift hash family: h_i(x) = (a_i * x + b_i) mod 2**64, top 32 bits
+MINHASH_A = _minhash_rng.integers(1, 2**63, MINHASH_PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+MINHASH_B = _minhash_rng.integers(0, 2**63, MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+def minhash_signature(tokens):
+    """
+    MinHash signature (uint32[MINHASH_PERMUTATIONS]) of the word 3-gram shingles of tokens.
+    """
+    shingles = {" ".join(tokens[i:i + 3]) for i in range(max(1, len(tokens) - 2))}
+    values = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64,
+                         count=len(shingles))
+    hashed = (values[:, None] * MINHASH_A + MINHASH_B) >> np.uint64(32)
+    return hashed.min(axis=0).astype(np.uint32)
+
+def lsh_buckets(signature):
+    rows = len(signature) // MINHASH_BANDS
+    return [(band, zlib.crc32(signature[band * rows:(band + 1) * rows].tobytes()))
+            for band in range(MINHASH_BANDS)]
+
+def find_near_duplicate(c, signature):
+    """
+    Returns the id of a canonical paragraph whose estimated Jaccard similarity with signature
+    reaches MINHASH_THRESHOLD, or None. Candidates share at least one LSH bucket.
+    """
+    buckets = lsh_buckets(signature)
+    c.execute(f'''
+        SELECT p.id, p.minhash
+        FROM pdf_paragraphs p
+        WHERE p.id IN (
+            SELECT paragraph_id FROM pdf_paragraph_lsh
+            WHERE (band, bucket) IN (VALUES {",".join("(?, ?)" for _ in buckets)})
+        )
+        ORDER BY p.id
+    ''', [value for bucket in buckets for value in bucket])
+    best_id, best_similarity = None, 0.0
+    for paragraph_id, minhash in c.fetchall():
+        similarity = float(np.mean(np.frombuffer(minhash, dtype=np.uint32) == signature))
+        if similarity > best_similarity:
+            best_id, best_similarity = paragraph_id, similarity
+    return best_id if best_similarity >= MINHASH_THRESHOLD else None
+
+def paragraph_copy_rank(year, paragraph_id):
+    # The copy in the most recent PDF wins; without years, the latest ingested one
+    return (year is not None, year or 0, paragraph_id)
+
+def load_paragraph_copies(c, paragraph_ids, filters=()):
+    """
+    Returns {paragraph_id: (text, pdf_name, citation, page_number)} for canonical paragraph ids.
+    text is the indexed canonical text; the PDF and page are those of the copy (the canonical
+    paragraph or one of its near-duplicates) with the best paragraph_copy_rank among the copies
+    in PDFs that pass the parsed metadata filters, so filtered searches, citations and the
+    recency reranker see the matching revision rather than the first one ingested.
+    """
+    if not paragraph_ids:
+        return {}
+    placeholders = ",".join("?" * len(paragraph_ids))
+    where, params = metadata_filter_sql(filters)
+    c.execute(f'''
+        SELECT i.id, i.text, p.id, p.page_number, t.pdf_name, t.citation, t.year
+        FROM pdf_paragraphs i
+        JOIN pdf_paragraphs p ON p.id = i.id OR p.canonical_id = i.id
+        JOIN pdf_texts t ON t.id = p.pdf_id
+        WHERE i.id IN ({placeholders})
+        {f"AND p.pdf_id IN (SELECT id FROM pdf_texts WHERE {where})" if where else ""}
+    ''', list(paragraph_ids) + params)
+    best = {}
+    for paragraph_id, text, copy_id, page_number, pdf_name, citation, year in c.fetchall():
+        rank = paragraph_copy_rank(year, copy_id)
+        if paragraph_id not in best or rank > best[paragraph_id][0]:
+            best[paragraph_id] = (rank, text, pdf_name, citation, page_number)
+    return {paragraph_id: entry[1:] for paragraph_id, entry in best.items()}
+
+def newest_paragraph_copies(conn):
+    """
+    Unfiltered load_paragraph_copies for the whole corpus, used when building the corpus cache
+    and file: {canonical paragraph id: (pdf_id, page_number)} of the chosen copy, for canonical
+    paragraphs that have near-duplicates.
+    """
+    best = {}
+    rows = conn.execute('''
+        SELECT COALESCE(p.canonical_id, p.id), p.id, p.pdf_id, p.page_number, t.year
+        FROM pdf_paragraphs p
+        JOIN pdf_texts t ON t.id = p.pdf_id
+        WHERE p.canonical_id IS NOT NULL
+           OR p.id IN (SELECT canonical_id FROM pdf_paragraphs WHERE canonical_id IS NOT NULL)
+    ''')
+    for paragraph_id, copy_id, pdf_id, page_number, year in rows:
+        rank = paragraph_copy_rank(year, copy_id)
+        if paragraph_id not in best or rank > best[paragraph_id][0]:
+            best[paragraph_id] = (rank, pdf_id, page_number)
+    return {paragraph_id: entry[1:] for paragraph_id, entry in best.items()}
+
+# ---------------------
+# Term Bloom Filters
+# ---------------------
+# Query words match as case-insensitive substrings, so the filters hold the character trigrams
+# of every whitespace-delimited term: a word can only occur in a document containing all of its
+# trigrams. Layout: one byte with the number of probes, followed by the bit array.
+def bloom_entries(content):
+    entries = set()
+    for term in content.lower().split():
+        entries.update(term[i:i + 3] for i in range(len(term) - 2))
+    return entries
+
+def bloom_hashes(entry):
+    digest = hashlib.blake2b(entry.encode("utf-8"), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+def build_term_bloom(content, bits_per_entry=None, num_hashes=None):
+    bits_per_entry = bits_per_entry or TERM_BLOOM_BITS_PER_ENTRY
+    num_hashes = num_hashes or TERM_BLOOM_HASHES
+    entries = bloom_entries(content)
+    n_bits = max(64, -(-len(entries) * bits_per_entry // 8) * 8)
+    bits = bytearray(n_bits // 8)
+    for entry in entries:
+        h1, h2 = bloom_hashes(entry)
+        for i in range(num_hashes):
+            position = (h1 + i * h2) % n_bits
+            bits[position >> 3] |= 1 << (position & 7)
+    return bytes([num_hashes]) + bytes(bits)
+
+def bloom_query_probes(user_message):
+    """
+    Returns lists of trigram hash pairs, one of which must be fully present, for the query as
+    query_matcher reads it: a single list over every phrase and NEAR operand token, since they
+    are all required, or otherwise one list per query word. Returns None when the filters cannot
+    rule a document out (no usable tokens, or an optional word shorter than a trigram).
+    """
+    constraints, terms = parse_query_constraints(user_message)
+    operands = [tokens for group, _ in constraints for tokens in group]
+    if operands:
+        required = [bloom_hashes(token[i:i + 3]) for tokens in operands for token in tokens
+                    for i in range(len(token) - 2)]
+        return [required] if required else None
+    probes = []
+    for word in terms:
+        if len(word) < 3:
+            return None
+        probes.append([bloom_hashes(word[i:i + 3]) for i in range(len(word) - 2)])
+    return probes or None
+
+def bloom_may_match(term_bloom, probes):
+    if not term_bloom or probes is None:
+        return True
+    num_hashes, bits = term_bloom[0], memoryview(term_bloom)[1:]
+    n_bits = len(bits) * 8
+    for word_probes in probes:
+        if all(
+            bits[((h1 + i * h2) % n_bits) >> 3] & (1 << (((h1 + i * h2) % n_bits) & 7))
+            for h1, h2 in word_probes
+            for i in range(num_hashes)
+        ):
+            return True
+    return False
+
+class BloomScanStats:
+    """
+    Counts documents checked and skipped by the Bloom filters during pdf_texts scans.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.scans = 0
+        self.checked = 0
+        self.skipped = 0
+
+    def record(self, checked, skipped):
+        with self._lock:
+            self.scans += 1
+            self.checked += checked
+            self.skipped += skipped
+
+    def stats(self):
+        with self._lock:
+            return {
+                "scans": self.scans,
+                "documents_checked": self.checked,
+                "documents_skipped": self.skipped,
+                "skip_rate": round(self.skipped / self.checked, 4) if self.checked else 0.0
+            }
+
+bloom_scan_stats = BloomScanStats()
+
+# ---------------------
+# Corpus Cache
+# ---------------------
+class CorpusSnapshot:
+    """
+    Immutable in-memory copy of pdf_paragraphs for one corpus generation: paragraph text,
+    precomputed citations, per-paragraph term counts and an inverted index for BM25.
+    When built from a MappedCorpus (texts) the text stays in the mapped file and is read by offset.
+    """
+    def __init__(self, generation, texts=None):
+        self.generation = generation
+        self.texts = texts
+        self.paragraphs = []  # (paragraph_id, text, pdf_name, citation, page_number, length, term_counts)
+        self.postings = {}    # term -> indexes into self.paragraphs, in paragraph_id order
+        self.token_count = 0
+        self.estimated_bytes = 0
+
+    def add(self, paragraph_id, text, pdf_name, citation, page_number, length):
+        term_counts = {}
+        for token in tokenize(text):
+            term_counts[token] = term_counts.get(token, 0) + 1
+        index = len(self.paragraphs)
+        for term in term_counts:
+            self.postings.setdefault(term, []).append(index)
+        if self.texts is not None:
+            text = None
+        self.paragraphs.append((paragraph_id, text, pdf_name, citation, page_number, length, term_counts))
+        self.token_count += length
+        # Rough accounting: the text itself plus per-term dict and postings entries
+        self.estimated_bytes += sys.getsizeof(text) + 200 + 120 * len(term_counts)
+
+    def search(self, query_terms, max_paragraphs, ranked=True):
+        query_terms = [term for term in dict.fromkeys(query_terms) if term in self.postings]
+        if not query_terms:
+            return []
+        candidates = set()
+        for term in query_terms:
+            candidates.update(self.postings[term])
+        if not ranked:
+            return [self._result(index) for index in heapq.nsmallest(max_paragraphs, candidates)]
+
+        doc_freqs = {term: len(self.postings[term]) for term in query_terms}
+        paragraph_count = len(self.paragraphs)
+        avg_length = (self.token_count / paragraph_count) or 1.0
+        heap = []
+        for index in candidates:
+            paragraph = self.paragraphs[index]
+            score = bm25_score(paragraph[6], paragraph[5], doc_freqs, paragraph_count, avg_length)
+            push_top_k(heap, max_paragraphs, score, paragraph[0], index)
+        return [
+            dict(self._result(index), score=round(score, 4))
+            for score, _, index in sorted(heap, reverse=True)
+        ]
+
+    def _result(self, index):
+        paragraph = self.paragraphs[index]
+        text = paragraph[1] if self.texts is None else self.texts.text(index)
+        return {"paragraph": text, "source": paragraph[3], "pdf_name": paragraph[2],
+                "page_number": paragraph[4]}
+
+def load_corpus_snapshot(generation, max_bytes):
+    """
+    Streams pdf_paragraphs into a CorpusSnapshot; returns None as soon as the estimated
+    size passes max_bytes so callers fall back to the database. A corpus file of the same
+    generation is used instead of the database, and its text is not copied into the snapshot.
+    """
+    corpus_file = mapped_corpus(generation)
+    if corpus_file is not None:
+        corpus = CorpusSnapshot(generation, texts=corpus_file)
+        for index in range(len(corpus_file)):
+            pdf_name, citation = corpus_file.document(index)
+            corpus.add(int(corpus_file.paragraph_ids[index]), corpus_file.text(index), pdf_name, citation,
+                       corpus_file.page_number(index), int(corpus_file.lengths[index]))
+            if corpus.estimated_bytes > max_bytes:
+                logging.warning(f"PDF corpus exceeds the {max_bytes} byte cache ceiling; using the database")
+                return None
+        logging.info(f"Loaded {len(corpus.paragraphs)} paragraphs from {CORPUS_FILE_PATH} into the corpus cache "
+                     f"(generation {generation}, ~{corpus.estimated_bytes // 1024} KiB)")
+        return corpus
+    corpus = CorpusSnapshot(generation)
+    with sqlite3.connect("pdf_cache.db") as conn:
+        citations = {
+            pdf_id: (pdf_name, citation)
+            for pdf_id, pdf_name, citation in conn.execute("SELECT id, pdf_name, citation FROM pdf_texts")
+        }
+        copies = newest_paragraph_copies(conn)
+        rows = conn.execute(
+            "SELECT id, pdf_id, text, page_number, length FROM pdf_paragraphs WHERE canonical_id IS NULL ORDER BY id"
+        )
+        for paragraph_id, pdf_id, text, page_number, length in rows:
+            pdf_id, page_number = copies.get(paragraph_id, (pdf_id, page_number))
+            pdf_name, citation = citations[pdf_id]
+            corpus.add(paragraph_id, text, pdf_name, citation, page_number, length)
+            if corpus.estimated_bytes > max_bytes:
+                logging.warning(f"PDF corpus exceeds the {max_bytes} byte cache ceiling; using the database")
+                return None
+    logging.info(f"Loaded {len(corpus.paragraphs)} paragraphs into the corpus cache "
+                 f"(generation {generation}, ~{corpus.estimated_bytes // 1024} KiB)")
+    return corpus
+
+class CorpusGenerationWatcher:
+    """
+    Tracks the generation counter bumped by batch_insert_pdfs. The counter is re-read from
+    pdf_cache.db at most every check_interval seconds, so warm requests do not touch SQLite.
+    """
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._generation = None
+        self._checked_at = None
+
+    def _fresh(self, now):
+        return self._checked_at is not None and now - self._checked_at < self.check_interval
+
+    def current(self):
+        """
+        Returns the corpus generation, or None when the PDF tables are not available.
+        """
+        now = time.monotonic()
+        if self._fresh(now):
+            return self._generation
+        with self._lock:
+            if not self._fresh(now):
+                try:
+                    self._generation = read_corpus_generation()
+                except sqlite3.Error as e:
+                    logging.warning(f"Corpus generation unavailable: {e}")
+                    self._generation = None
+                self._checked_at = now
+            return self._generation
+
+    def invalidate(self):
+        self._checked_at = None
+
+corpus_generation = CorpusGenerationWatcher(CORPUS_CACHE_CHECK_INTERVAL)
+
+class CorpusCache:
+    """
+    Process-wide holder of the current CorpusSnapshot, rebuilt when the corpus generation changes.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._oversized_generation = None
+
+    def get(self):
+        if self.max_bytes <= 0:
+            return None
+        generation = corpus_generation.current()
+        if generation is None:
+            return None
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.generation == generation:
+            return snapshot
+        with self._lock:
+            if self._snapshot is not None and self._snapshot.generation == generation:
+                return self._snapshot
+            if self._oversized_generation == generation:
+                return None
+            try:
+                self._snapshot = load_corpus_snapshot(generation, self.max_bytes)
+            except sqlite3.Error as e:
+                logging.warning(f"Corpus cache unavailable: {e}")
+                self._snapshot = None
+                return None
+            self._oversized_generation = None if self._snapshot else generation
+            return self._snapshot
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+            self._oversized_generation = None
+
+corpus_cache = CorpusCache(CORPUS_CACHE_MAX_BYTES)
+
+class QueryResultCache:
+    """
+    Bounded LRU cache with a TTL for search_pdfs_helper results. Entries remember the corpus
+    generation they were computed for and are dropped once it changes.
+    """
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (generation, expires_at, results)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, generation):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] != generation or entry[1] < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, generation, results):
+        if self.max_entries <= 0 or generation is None:
+            return
+        with self._lock:
+            self._entries[key] = (generation, time.monotonic() + self.ttl, results)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+query_result_cache = QueryResultCache(QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_TTL)
+
+# ---------------------
+# TF-IDF Retriever
+# ---------------------
+def hash_term(term, n_features):
+    # crc32 rather than hash() so buckets are stable across processes and restarts
+    return zlib.crc32(term.encode("utf-8")) & (n_features - 1)
+
+def hashed_term_weights(text, n_features):
+    """
+    Returns {bucket: 1 + log(tf)} for the tokens of text.
+    """
+    counts = {}
+    for token in tokenize(text):
+        bucket = hash_term(token, n_features)
+        counts[bucket] = counts.get(bucket, 0) + 1
+    return {bucket: 1.0 + math.log(count) for bucket, count in counts.items()}
+
+def build_tfidf_index(path=None, hash_bits=None):
+    """
+    Builds an L2-normalized hashed TF-IDF matrix (CSR arrays) over pdf_paragraphs and saves it
+    as an .npz file, tagged with the corpus generation it was built from. Runs fully offline;
+    no embedding service is involved.
+    """
+    path = path or TFIDF_INDEX_PATH
+    n_features = 1 << (hash_bits or TFIDF_HASH_BITS)
+    paragraph_ids, indptr, indices, values = [], [0], [], []
+    try:
+        # Read before the paragraphs: if the corpus changes meanwhile, the index is tagged older
+        generation = read_corpus_generation()
+        with sqlite3.connect("pdf_cache.db") as conn:
+            rows = conn.execute("SELECT id, text FROM pdf_paragraphs WHERE canonical_id IS NULL ORDER BY id")
+            for paragraph_id, text in rows:
+                weights = hashed_term_weights(text, n_features)
+                paragraph_ids.append(paragraph_id)
+                indices.extend(weights.keys())
+                values.extend(weights.values())
+                indptr.append(len(indices))
+    except sqlite3.Error as e:
+        logging.error(f"Error building TF-IDF index: {e}")
+        return
+
+    indices = np.asarray(indices, dtype=np.int32)
+    doc_freqs = np.bincount(indices, minlength=n_features)
+    idf = (np.log((1 + len(paragraph_ids)) / (1 + doc_freqs)) + 1).astype(np.float32)
+    data = np.asarray(values, dtype=np.float32) * idf[indices]
+    indptr = np.asarray(indptr, dtype=np.int64)
+    rows = np.repeat(np.arange(len(paragraph_ids)), np.diff(indptr))
+    row_norms = np.sqrt(np.bincount(rows, weights=data * data, minlength=len(paragraph_ids)))
+    data /= row_norms[rows].astype(np.float32)
+    # Written to a temporary file and renamed, so workers reloading on mtime never see a partial file
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as out:
+            np.savez(out, paragraph_ids=np.asarray(paragraph_ids, dtype=np.int64), indptr=indptr,
+                     indices=indices, data=data, idf=idf, generation=np.int64(generation))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.error(f"Error saving TF-IDF index: {e}")
+        return
+    logging.info(f"Saved TF-IDF index for {len(paragraph_ids)} paragraphs to {path}")
+
+_tfidf_index = {"key": None, "arrays": None}
+_tfidf_lock = threading.Lock()
+
+def load_tfidf_index(path=None):
+    """
+    Returns the arrays of the saved TF-IDF index, reloading them only when the file changes.
+    If a reload fails, the previously loaded arrays are kept.
+    """
+    path = path or TFIDF_INDEX_PATH
+    try:
+        key = (path, os.path.getmtime(path))
+    except OSError:
+        return None
+    with _tfidf_lock:
+        if _tfidf_index["key"] != key:
+            try:
+                with np.load(path) as saved:
+                    arrays = {name: saved[name] for name in saved.files}
+                # Indexes saved before generations were recorded never match the current corpus
+                arrays["generation"] = int(arrays["generation"]) if "generation" in arrays else None
+                # Row number of every stored value, so a matrix-vector product is a single bincount
+                arrays["rows"] = np.repeat(np.arange(len(arrays["paragraph_ids"])), np.diff(arrays["indptr"]))
+            except Exception as e:
+                logging.error(f"Error loading TF-IDF index {path}, keeping the previous one: {e}")
+                return _tfidf_index["arrays"]
+            _tfidf_index["arrays"] = arrays
+            _tfidf_index["key"] = key
+        return _tfidf_index["arrays"]
+
+def search_tfidf_index(index, user_message, max_paragraphs=5):
+    """
+    Scores every paragraph with one sparse matrix-vector product and selects the
+    top max_paragraphs with argpartition.
+    """
+    idf = index["idf"]
+    paragraph_count = len(index["paragraph_ids"])
+    weights = hashed_term_weights(user_message, len(idf))
+    if not weights or not paragraph_count:
+        return []
+    query = np.zeros(len(idf), dtype=np.float32)
+    for bucket, weight in weights.items():
+        query[bucket] = weight * idf[bucket]
+    query /= np.linalg.norm(query) or 1.0
+
+    scores = np.bincount(index["rows"], weights=index["data"] * query[index["indices"]], minlength=paragraph_count)
+    k = min(max_paragraphs, paragraph_count)
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind="stable")]
+    scored_ids = [(int(index["paragraph_ids"][i]), float(scores[i])) for i in top if scores[i] > 0]
+    with sqlite3.connect("pdf_cache.db") as conn:
+        return load_paragraph_results(conn.cursor(), scored_ids)
+
+# ---------------------
+# Memory-Mapped Corpus File
+# ---------------------
+# Layout: header | UTF-8 paragraph text | paragraph_ids int64[n] | offsets int64[n + 1] |
+# pdf_indexes int32[n] | page_numbers int32[n] (-1 = unknown) | lengths int32[n] | documents JSON,
+# where offsets index the text blob and pdf_indexes index the [[pdf_name, citation], ...] documents.
+CORPUS_FILE_MAGIC = b"PDFCORP1"
+CORPUS_FILE_HEADER = struct.Struct("<8s6q")  # magic, generation, n, text_start, text_len, arrays_start, docs_start
+
+def build_corpus_file(path=None):
+    """
+    Writes pdf_paragraphs as a compact corpus file. The file is written next to its final
+    path and renamed into place, so workers mapping the previous file keep a consistent view.
+    """
+    path = path or CORPUS_FILE_PATH
+    tmp_path = f"{path}.tmp"
+    paragraph_ids, offsets, pdf_indexes, page_numbers, lengths = [], [0], [], [], []
+    documents, document_indexes = [], {}
+    try:
+        with sqlite3.connect("pdf_cache.db") as conn, open(tmp_path, "wb") as out:
+            row = conn.execute("SELECT value FROM pdf_index_stats WHERE name = 'generation'").fetchone()
+            generation = row[0] if row else 0
+            for pdf_id, pdf_name, citation in conn.execute("SELECT id, pdf_name, citation FROM pdf_texts ORDER BY id"):
+                document_indexes[pdf_id] = len(documents)
+                documents.append([pdf_name, citation])
+            out.write(bytes(CORPUS_FILE_HEADER.size))
+            copies = newest_paragraph_copies(conn)
+            rows = conn.execute(
+                "SELECT id, pdf_id, text, page_number, length FROM pdf_paragraphs WHERE canonical_id IS NULL ORDER BY id"
+            )
+            for paragraph_id, pdf_id, text, page_number, length in rows:
+                pdf_id, page_number = copies.get(paragraph_id, (pdf_id, page_number))
+                encoded = text.encode("utf-8")
+                out.write(encoded)
+                paragraph_ids.append(paragraph_id)
+                offsets.append(offsets[-1] + len(encoded))
+                pdf_indexes.append(document_indexes[pdf_id])
+                page_numbers.append(-1 if page_number is None else page_number)
+                lengths.append(length)
+            text_len = offsets[-1]
+            # Keep the int64 arrays 8-byte aligned for zero-copy numpy views
+            out.write(bytes(-text_len % 8))
+            arrays_start = out.tell()
+            for values, dtype in ((paragraph_ids, np.int64), (offsets, np.int64), (pdf_indexes, np.int32),
+                                  (page_numbers, np.int32), (lengths, np.int32)):
+                out.write(np.asarray(values, dtype=dtype).tobytes())
+            docs = json.dumps(documents).encode("utf-8")
+            docs_start = out.tell()
+            out.write(docs)
+            out.seek(0)
+            out.write(CORPUS_FILE_HEADER.pack(CORPUS_FILE_MAGIC, generation, len(paragraph_ids),
+                                              CORPUS_FILE_HEADER.size, text_len, arrays_start, docs_start))
+        os.replace(tmp_path, path)
+    except (sqlite3.Error, OSError) as e:
+        logging.error(f"Error building corpus file: {e}")
+        return
+    logging.info(f"Saved {len(paragraph_ids)} paragraphs ({text_len} text bytes) to {path}")
+
+class MappedCorpus:
+    """
+    Read-only view of a corpus file. The file is mmap'ed, so every worker process shares
+    the same page-cache copy; the arrays are numpy views into the mapping and paragraph
+    text is decoded only when a paragraph is read.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.generation, count, self._text_start, text_len, arrays_start, docs_start = \
+            CORPUS_FILE_HEADER.unpack_from(self._map)
+        if magic != CORPUS_FILE_MAGIC:
+            raise ValueError(f"{path} is not a corpus file")
+        offset = arrays_start
+        arrays = []
+        for dtype, length in ((np.int64, count), (np.int64, count + 1), (np.int32, count),
+                              (np.int32, count), (np.int32, count)):
+            arrays.append(np.frombuffer(self._map, dtype=dtype, count=length, offset=offset))
+            offset += arrays[-1].nbytes
+        self.paragraph_ids, self.offsets, self.pdf_indexes, self.page_numbers, self.lengths = arrays
+        self.documents = json.loads(self._map[docs_start:].decode("utf-8"))
+
+    def __len__(self):
+        return len(self.paragraph_ids)
+
+    def text(self, index):
+        start = self._text_start + int(self.offsets[index])
+        end = self._text_start + int(self.offsets[index + 1])
+        return self._map[start:end].decode("utf-8")
+
+    def document(self, index):
+        pdf_name, citation = self.documents[self.pdf_indexes[index]]
+        return pdf_name, citation
+
+    def page_number(self, index):
+        page_number = int(self.page_numbers[index])
+        return page_number if page_number >= 0 else None
+
+    def find(self, paragraph_id):
+        index = int(np.searchsorted(self.paragraph_ids, paragraph_id))
+        if index < len(self.paragraph_ids) and self.paragraph_ids[index] == paragraph_id:
+            return index
+        return None
+
+    def load_results(self, scored_ids):
+        """
+        Same output as load_paragraph_results, read by offset from the mapped file.
+        """
+        results = []
+        for paragraph_id, score in scored_ids:
+            index = self.find(paragraph_id)
+            if index is None:
+                continue
+            pdf_name, citation = self.document(index)
+            results.append({
+                "paragraph": self.text(index),
+                "source": citation,
+                "pdf_name": pdf_name,
+                "page_number": self.page_number(index),
+                "score": round(score, 4)
+            })
+        return results
+
+_mapped_corpus = {"key": None, "corpus": None}
+_mapped_corpus_lock = threading.Lock()
+
+def mapped_corpus(generation=None, path=None):
+    """
+    Returns the MappedCorpus for path when it was built for generation (default: the current
+    corpus generation), remapping the file only when it changes on disk; otherwise None.
+    """
+    path = path or CORPUS_FILE_PATH
+    generation = generation if generation is not None else corpus_generation.current()
+    if generation is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    with _mapped_corpus_lock:
+        if _mapped_corpus["key"] != key:
+            try:
+                _mapped_corpus["corpus"] = MappedCorpus(path)
+            except (OSError, ValueError, struct.error) as e:
+                logging.warning(f"Corpus file {path} unavailable: {e}")
+                _mapped_corpus["corpus"] = None
+            _mapped_corpus["key"] = key
+        corpus = _mapped_corpus["corpus"]
+    if corpus is None or corpus.generation != generation:
+        return None
+    return corpus
+
+# ---------------------
+# Worker Process Pool
+# ---------------------
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+def worker_pool():
+    """
+    Returns the process pool shared by sharded retrieval and parallel text extraction, created
+    on first use with WORKER_PROCESSES workers and the WORKER_START_METHOD start method.
+    """
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = ProcessPoolExecutor(max_workers=WORKER_PROCESSES,
+                                               mp_context=multiprocessing.get_context(WORKER_START_METHOD))
+        return _worker_pool
+
+def reset_worker_pool(pool):
+    """
+    Drops a broken shared pool (a worker died) so the next worker_pool() call starts a new one.
+    """
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is pool:
+            _worker_pool = None
+    pool.shutdown(wait=False)
+    logging.warning("Worker process pool broke and was reset")
+
+# ---------------------
+# Sharded Retrieval
+# ---------------------
+
+def score_fts_shard(db_path, fts_query, bm25_stats, k, rowid_range, filters=()):
+    # Runs in a worker process: its own connection, the shared corpus statistics, one id range
+    with sqlite3.connect(db_path) as conn:
+        return top_k_fts_matches(conn.cursor(), fts_query, bm25_stats, k, rowid_range, filters)
+
+def rank_fts_matches_sharded(c, fts_query, query_terms, max_paragraphs, executor=None, shards=None, filters=()):
+    """
+    Same results as rank_fts_matches, but the paragraph ids are split into one contiguous range
+    per shard and each range is scored and top-k'd in a worker process. Corpus statistics are
+    read once here so every shard scores against the same document frequencies.
+    """
+    pool = executor or worker_pool()
+    shards = shards or SHARD_WORKERS
+    bm25_stats = load_bm25_stats(c, list(dict.fromkeys(query_terms)))
+    c.execute("SELECT MIN(id), MAX(id) FROM pdf_paragraphs")
+    first_id, last_id = c.fetchone()
+    if first_id is None:
+        return []
+    step = (last_id - first_id) // shards + 1
+    db_path = os.path.abspath("pdf_cache.db")
+    try:
+        futures = [
+            pool.submit(score_fts_shard, db_path, fts_query, bm25_stats, max_paragraphs,
+                        (start, min(start + step - 1, last_id)), filters)
+            for start in range(first_id, last_id + 1, step)
+        ]
+        # Heap entries are (score, -paragraph_id, paragraph_id), so ties still favour the lower id
+        best = heapq.nlargest(max_paragraphs, (entry for future in futures for entry in future.result()))
+    except BrokenProcessPool as e:
+        if executor is not None:
+            raise
+        reset_worker_pool(pool)
+        logging.warning(f"Sharded retrieval failed, ranking in-process: {e}")
+        return rank_fts_matches(c, fts_query, query_terms, max_paragraphs, filters)
+    return load_paragraph_results(c, [(paragraph_id, score) for score, _, paragraph_id in best], filters)
+
+# ---------------------
+# Two-Stage Reranking
+# ---------------------
+def two_stage_search(user_message, max_paragraphs=5, retriever=None, filters=(), candidates=None, time_budget_ms=None):
+    """
+    Stage 1 fetches the best max(candidates, max_paragraphs) paragraphs (default RERANK_CANDIDATES)
+    from the configured retriever; stage 2 reranks them with rerank_paragraphs and keeps
+    max_paragraphs. Both stages are timed into rerank_stats. Returns (results, degraded) as
+    retrieve_pdf_paragraphs_checked does for stage 1.
+    """
+    start = time.perf_counter()
+    k = max(candidates or RERANK_CANDIDATES, max_paragraphs)
+    stage1, degraded = retrieve_pdf_paragraphs_checked(user_message, k, True, retriever, filters)
+    stage1_ms = (time.perf_counter() - start) * 1000
+    return timed_rerank(user_message, stage1, max_paragraphs, stage1_ms, time_budget_ms), degraded
+
+def timed_rerank(user_message, candidates, max_paragraphs, stage1_ms, time_budget_ms=None):
+    start = time.perf_counter()
+    results, reranked = rerank_paragraphs(user_message, candidates, max_paragraphs, time_budget_ms)
+    stage2_ms = (time.perf_counter() - start) * 1000
+    rerank_stats.record(stage1_ms, stage2_ms, len(candidates), reranked)
+    logging.info(f"Two-stage search for '{user_message}': stage 1 {len(candidates)} candidates in {stage1_ms:.1f} ms, "
+                 f"stage 2 reranked {reranked} in {stage2_ms:.1f} ms")
+    return results
+
+def rerank_paragraphs(user_message, candidates, max_paragraphs, time_budget_ms=None):
+    """
+    Rescores first-stage candidates with local, CPU-only features, each in [0, 1] and weighted
+    by RERANK_WEIGHTS: the first-stage score relative to the best candidate, coverage of the
+    query terms, proximity of the matched terms and recency of the PDF's year. Candidates not
+    reached within time_budget_ms (default RERANK_TIME_BUDGET_MS) keep their first-stage order
+    after the reranked ones and are scored on the retrieval feature alone; since stage 1 is
+    sorted best first, that never exceeds a reranked score, so scores stay non-increasing. Every
+    result keeps its first-stage score as retrieval_score. Returns (results, number of candidates
+    reranked).
+    """
+    budget = (RERANK_TIME_BUDGET_MS if time_budget_ms is None else time_budget_ms) / 1000
+    _, terms = parse_search_query(user_message)
+    # Stopwords only count when the query has nothing else
+    matcher = QueryMatcher(terms, whole_words=True, drop_stopwords=True)
+    if not matcher.terms:
+        matcher = QueryMatcher(terms, whole_words=True)
+    if not matcher.terms or not candidates:
+        return candidates[:max_paragraphs], 0
+    top_score = max(candidate.get("score") or 0.0 for candidate in candidates) or 1.0
+    years = load_pdf_years()
+    this_year = datetime.now().year
+    start = time.perf_counter()
+    scored = []
+    for position, candidate in enumerate(candidates):
+        if time.perf_counter() - start > budget:
+            break
+        features = rerank_features(candidate["paragraph"], matcher)
+        features["retrieval"] = (candidate.get("score") or 0.0) / top_score
+        year = years.get(candidate["pdf_name"])
+        features["recency"] = 0.5 ** (max(0, this_year - year) / RERANK_RECENCY_HALF_LIFE) if year else 0.0
+        score = sum(RERANK_WEIGHTS.get(name, 0.0) * value for name, value in features.items())
+        scored.append((-score, position, candidate))
+    reranked = [
+        dict(candidate, score=round(-negative_score, 4), retrieval_score=candidate.get("score"))
+        for negative_score, _, candidate in sorted(scored, key=lambda entry: entry[:2])
+    ]
+    weight = RERANK_WEIGHTS.get("retrieval", 0.0)
+    unreached = [
+        dict(candidate, score=round(weight * (candidate.get("score") or 0.0) / top_score, 4),
+             retrieval_score=candidate.get("score"))
+        for candidate in candidates[len(scored):max_paragraphs]
+    ]
+    return (reranked + unreached)[:max_paragraphs], len(scored)
+
+def rerank_features(paragraph, matcher):
+    """
+    coverage: share of the whole-word matcher's query terms present in paragraph. proximity:
+    for two or more matched terms, (matched - 1) / (tokens in the shortest window holding all
+    of them - 1), so 1.0 means the matched terms are adjacent.
+    """
+    matched = matcher.matched_terms(paragraph)
+    proximity = 0.0
+    if len(matched) > 1:
+        positions = [(index, token) for index, token in enumerate(tokenize(paragraph)) if token in matched]
+        proximity = (len(matched) - 1) / (shortest_cover_window(positions, len(matched)) - 1)
+    return {"coverage": len(matched) / len(matcher.terms), "proximity": proximity}
+
+def shortest_cover_window(positions, needed):
+    # Sliding window over (token index, term) hits; returns the token length of the shortest
+    # window that contains `needed` distinct terms
+    counts = {}
+    best = float("inf")
+    left = 0
+    for index, token in positions:
+        counts[token] = counts.get(token, 0) + 1
+        while len(counts) == needed:
+            left_index, left_token = positions[left]
+            best = min(best, index - left_index + 1)
+            counts[left_token] -= 1
+            if not counts[left_token]:
+                del counts[left_token]
+            left += 1
+    return best
+
+_pdf_years = {"generation": None, "years": {}}
+_pdf_years_lock = threading.Lock()
+
+def load_pdf_years():
+    """
+    Returns {pdf_name: year} from the indexed year column, reloaded when the corpus generation changes.
+    """
+    generation = corpus_generation.current()
+    with _pdf_years_lock:
+        if _pdf_years["generation"] != generation or generation is None:
+            try:
+                with sqlite3.connect("pdf_cache.db") as conn:
+                    _pdf_years["years"] = dict(conn.execute(
+                        "SELECT pdf_name, year FROM pdf_texts WHERE year IS NOT NULL"
+                    ).fetchall())
+            except sqlite3.Error as e:
+                logging.warning(f"PDF years unavailable for reranking: {e}")
+                _pdf_years["years"] = {}
+            _pdf_years["generation"] = generation
+        return _pdf_years["years"]
+
+class RerankStats:
+    """
+    Per-stage timing and candidate counts of two-stage searches in this worker process.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.stage1_ms = 0.0
+        self.stage2_ms = 0.0
+        self.candidates = 0
+        self.reranked = 0
+        self.budget_exhausted = 0
+
+    def record(self, stage1_ms, stage2_ms, candidates, reranked):
+        with self._lock:
+            self.queries += 1
+            self.stage1_ms += stage1_ms
+            self.stage2_ms += stage2_ms
+            self.candidates += candidates
+            self.reranked += reranked
+            self.budget_exhausted += reranked < candidates
+
+    def stats(self):
+        with self._lock:
+            queries = self.queries or 1
+            return {
+                "queries": self.queries,
+                "candidate_budget": RERANK_CANDIDATES,
+                "time_budget_ms": RERANK_TIME_BUDGET_MS,
+                "avg_stage1_ms": round(self.stage1_ms / queries, 3),
+                "avg_stage2_ms": round(self.stage2_ms / queries, 3),
+                "avg_candidates": round(self.candidates / queries, 1),
+                "avg_reranked": round(self.reranked / queries, 1),
+                "budget_exhausted": self.budget_exhausted
+            }
+
+rerank_stats = RerankStats()
 
 # ---------------------
 # Context Summarization Functions
@@ -490,23 +2921,45 @@ def load_chat():
 @swag_from({
     'get': {
         'summary': 'Search PDFs',
-        'description': 'Search the cached PDFs for a given term.',
+        'description': 'Ranked, paginated search of the cached PDF paragraphs for a given term.',
         'parameters': [
-            {'name': 'search_term', 'in': 'query', 'type': 'string', 'required': True, 'description': 'The term to search for in PDF contents.'}
+            {'name': 'search_term', 'in': 'query', 'type': 'string', 'required': True, 'description': 'The term to search for in PDF contents. In ranked mode, "quoted phrases" and `a NEAR/k b` proximity constraints are supported.'},
+            {'name': 'page', 'in': 'query', 'type': 'integer', 'required': False, 'description': 'Page number, starting at 1.'},
+            {'name': 'page_size', 'in': 'query', 'type': 'integer', 'required': False, 'description': f'Results per page (at most {SEARCH_PAGE_SIZE_MAX}).'},
+            {'name': 'mode', 'in': 'query', 'type': 'string', 'required': False, 'enum': ['ranked', 'substring'], 'description': "'ranked' (default) for word search ordered by relevance, 'substring' for case-insensitive substring matches in document order."},
+            {'name': 'filter', 'in': 'query', 'type': 'array', 'items': {'type': 'string'}, 'collectionFormat': 'multi', 'required': False, 'description': 'Metadata filters on author, year, title or publisher with =, !=, <, <=, > or >=, e.g. year>=2018 or publisher=Elsevier. Repeat to combine.'}
         ],
         'responses': {
             '200': {
-                'description': 'The first matching PDF record.',
+                'description': 'One page of matching paragraphs, best first.',
                 'schema': {
                     'type': 'object',
                     'properties': {
-                        'pdf_name': {'type': 'string'},
-                        'content': {'type': 'string'},
-                        'metadata': {'type': 'string'}
+                        'search_term': {'type': 'string'},
+                        'mode': {'type': 'string'},
+                        'page': {'type': 'integer'},
+                        'page_size': {'type': 'integer'},
+                        'total': {'type': 'integer'},
+                        'results': {
+                            'type': 'array',
+                            'items': {
+                                'type': 'object',
+                                'properties': {
+                                    'paragraph_id': {'type': 'integer'},
+                                    'pdf_name': {'type': 'string'},
+                                    'citation': {'type': 'string'},
+                                    'page_number': {'type': 'integer'},
+                                    'snippet': {'type': 'string'},
+                                    'highlights': {'type': 'array', 'items': {'type': 'array', 'items': {'type': 'integer'}}},
+                                    'score': {'type': 'number'}
+                                }
+                            }
+                        }
                     }
                 }
             },
-            '400': {'description': 'No search term provided.'}
+            '400': {'description': 'No search term provided, or invalid paging parameters or filters.'},
+            '500': {'description': 'Internal server error.'}
         }
     }
 })
@@ -516,16 +2969,144 @@ def search_pdfs():
     if not search_term:
         logging.error("No search_term provided.")
         return jsonify({"error": "No search term provided"}), 400
-    with sqlite3.connect("pdf_cache.db") as conn:
-        c = conn.cursor()
-        c.execute('''
-            SELECT pdf_name, content, metadata
-            FROM pdf_texts
-            WHERE content LIKE ?
-            LIMIT 1
-        ''', (f"%{search_term}%",))
-        row = c.fetchone()
-    return jsonify(row), 200
+    try:
+        page = int(request.args.get('page', 1))
+        page_size = int(request.args.get('page_size', SEARCH_PAGE_SIZE_DEFAULT))
+    except ValueError:
+        logging.error("Invalid paging parameters.")
+        return jsonify({"error": "page and page_size must be integers"}), 400
+    if page < 1 or not 1 <= page_size <= SEARCH_PAGE_SIZE_MAX:
+        logging.error("Paging parameters out of range.")
+        return jsonify({"error": f"page must be >= 1 and page_size between 1 and {SEARCH_PAGE_SIZE_MAX}"}), 400
+    mode = request.args.get('mode', 'ranked')
+    if mode not in ('ranked', 'substring'):
+        logging.error(f"Invalid search mode: {mode}")
+        return jsonify({"error": "mode must be 'ranked' or 'substring'"}), 400
+    try:
+        filters = parse_metadata_filters(request.args.getlist('filter'))
+    except ValueError as e:
+        logging.error(f"Invalid search filter: {e}")
+        return jsonify({"error": str(e)}), 400
+    try:
+        if mode == 'substring':
+            result = search_pdfs_substring(search_term, page, page_size, filters)
+        else:
+            result = search_pdfs_page(search_term, page, page_size, filters)
+    except Exception as e:
+        logging.error(f"Error searching PDFs: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+    return jsonify({"search_term": search_term, "mode": mode, "page": page, "page_size": page_size, **result}), 200
+
+@app.route('/search_pdfs/batch', methods=['POST'])
+@swag_from({
+    'post': {
+        'summary': 'Batch Search PDFs',
+        'description': (
+            "Ranked search of the cached PDF paragraphs for many queries at once, e.g. evaluation "
+            "question sets. Plain-word queries share a single pass over the search index."
+        ),
+        'parameters': [
+            {
+                'name': 'body',
+                'in': 'body',
+                'schema': {
+                    'type': 'object',
+                    'properties': {
+                        'queries': {'type': 'array', 'items': {'type': 'string'}, 'maxItems': SEARCH_BATCH_MAX_QUERIES},
+                        'max_paragraphs': {'type': 'integer', 'minimum': 1, 'maximum': SEARCH_PAGE_SIZE_MAX}
+                    },
+                    'required': ['queries']
+                }
+            }
+        ],
+        'responses': {
+            '200': {
+                'description': 'Ranked paragraphs for every query, in request order.',
+                'schema': {
+                    'type': 'object',
+                    'properties': {
+                        'results': {
+                            'type': 'array',
+                            'items': {
+                                'type': 'object',
+                                'properties': {
+                                    'query': {'type': 'string'},
+                                    'results': {
+                                        'type': 'array',
+                                        'items': {
+                                            'type': 'object',
+                                            'properties': {
+                                                'paragraph': {'type': 'string'},
+                                                'source': {'type': 'string'},
+                                                'pdf_name': {'type': 'string'},
+                                                'page_number': {'type': 'integer'},
+                                                'score': {'type': 'number'}
+                                            }
+                                        }
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            },
+            '400': {'description': 'Missing or invalid queries or max_paragraphs.'},
+            '500': {'description': 'Internal server error.'}
+        }
+    }
+})
+def search_pdfs_batch():
+    logging.info("Batch searching PDFs.")
+    data = request.json or {}
+    queries = data.get('queries')
+    if not isinstance(queries, list) or not queries or not all(isinstance(query, str) for query in queries):
+        logging.error("Invalid batch queries received.")
+        return jsonify({"error": "queries must be a non-empty list of strings"}), 400
+    if len(queries) > SEARCH_BATCH_MAX_QUERIES:
+        logging.error(f"Too many batch queries: {len(queries)}")
+        return jsonify({"error": f"At most {SEARCH_BATCH_MAX_QUERIES} queries per batch"}), 400
+    try:
+        max_paragraphs = int(data.get('max_paragraphs', 5))
+    except (TypeError, ValueError):
+        logging.error("max_paragraphs must be an integer.")
+        return jsonify({"error": "max_paragraphs must be an integer"}), 400
+    if not 1 <= max_paragraphs <= SEARCH_PAGE_SIZE_MAX:
+        logging.error("max_paragraphs out of range.")
+        return jsonify({"error": f"max_paragraphs must be between 1 and {SEARCH_PAGE_SIZE_MAX}"}), 400
+    try:
+        results = search_pdfs_batch_helper(queries, max_paragraphs)
+    except Exception as e:
+        logging.error(f"Error batch searching PDFs: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+    return jsonify({"results": [{"query": query, "results": ranked} for query, ranked in zip(queries, results)]}), 200
+
+@app.route('/search_stats', methods=['GET'])
+@swag_from({
+    'get': {
+        'summary': 'Retrieval Statistics',
+        'description': 'Counters of the PDF retrieval caches, scan filters and reranker in this worker process.',
+        'responses': {
+            '200': {
+                'description': 'Query-result cache, Bloom filter scan and two-stage rerank counters.',
+                'schema': {
+                    'type': 'object',
+                    'properties': {
+                        'query_cache': {'type': 'object'},
+                        'bloom_scan': {'type': 'object'},
+                        'rerank': {'type': 'object'}
+                    }
+                }
+            }
+        }
+    }
+})
+def search_stats():
+    logging.info("Reporting retrieval statistics.")
+    return jsonify({
+        "query_cache": query_result_cache.stats(),
+        "bloom_scan": bloom_scan_stats.stats(),
+        "rerank": rerank_stats.stats()
+    }), 200
 
 @app.route('/chat', methods=['POST'])
 @swag_from({
@@ -1265,6 +3846,6 @@ def loadConversation():
 if __name__ == '__main__':
     init_db()
     init_user_db()
-    #init_pdf_cache_db()
+    init_pdf_cache_db()
     #preprocess_pdfs_to_db(limit=100)
     app.run(host='0.0.0.0', port=8000, debug=True)
@@ -0,0 +1,63 @@
+"""
+Benchmark: local PyMuPDF text extraction of one large PDF in the calling process versus
+page ranges extracted in parallel by a process pool (local_page_texts with an executor).
+
+Generates a synthetic multi-hundred-page PDF in memory (the parallel path spools it to one
+temporary file for the workers) and makes no Form Recognizer calls. Extraction is CPU bound, so latency should drop roughly with
+the worker count until it reaches the number of cores.
+
+    python benchmark_extraction.py --pages 600 --workers 1 2 4 8 --pages-per-task 16 32 64
+"""
+import argparse
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz  # PyMuPDF
+
+import app
+from benchmark_trigram import best_time, random_paragraph
+
+def build_pdf(pages, paragraphs, seed):
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for page_index in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 60), f"Section {page_index + 1}", fontsize=14)
+        y = 90
+        for _ in range(paragraphs):
+            rect = fitz.Rect(72, y, 540, y + 60)
+            page.insert_textbox(rect, random_paragraph(rng), fontsize=9)
+            y += 66
+    return doc.tobytes()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=400)
+    parser.add_argument("--paragraphs", type=int, default=10)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument("--pages-per-task", type=int, nargs="+", default=[app.EXTRACT_PAGES_PER_TASK])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    pdf_bytes = build_pdf(args.pages, args.paragraphs, args.seed)
+    print(f"Built a {args.pages}-page PDF ({len(pdf_bytes) / 1e6:.1f} MB, {os.cpu_count()} cores)")
+
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        single, expected = best_time(lambda: [app.local_page_text(page) for page in doc], args.repeat)
+        print(f"single process {single * 1000:9.1f} ms")
+        for workers in sorted(set(args.workers)):
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # Warm up the pool so process start-up is not counted
+                list(executor.map(abs, range(workers)))
+                for pages_per_task in sorted(set(args.pages_per_task)):
+                    parallel, result = best_time(
+                        lambda: app.local_page_texts(doc, pdf_bytes, executor, pages_per_task), args.repeat
+                    )
+                    assert result == expected, "parallel extraction differs from the single-process text"
+                    print(f"{workers:3} workers, {pages_per_task:3} pages/task {parallel * 1000:9.1f} ms  "
+                          f"speed-up {single / parallel:5.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark: ranked BM25 retrieval in one process (rank_fts_matches) versus the sharded
+retriever (rank_fts_matches_sharded) with 1 to N worker processes.
+
+Builds a synthetic corpus in a temporary directory, so it never touches pdf_cache.db.
+Broad queries matching most paragraphs are where sharding pays off; latency should drop
+roughly with the worker count until it reaches the number of cores.
+
+    python benchmark_sharded.py --docs 2000 --paragraphs 200 --workers 1 2 4 8 16 32
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import app
+from benchmark_trigram import best_time, build_corpus
+
+QUERIES = ["silicone hydrogel", "lens oxygen permeability", "\"contact lens\" polymer"]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=1000)
+    parser.add_argument("--paragraphs", type=int, default=100)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        start = time.perf_counter()
+        build_corpus(args.docs, args.paragraphs, args.seed)
+        print(f"Built {args.docs} docs x {args.paragraphs} paragraphs in {time.perf_counter() - start:.1f}s "
+              f"({os.cpu_count()} cores)")
+
+        with sqlite3.connect("pdf_cache.db") as conn:
+            c = conn.cursor()
+            for query in QUERIES:
+                fts_query = app.build_fts_query(query)
+                _, terms = app.parse_search_query(query)
+                single, expected = best_time(lambda: app.rank_fts_matches(c, fts_query, terms, args.top_k), args.repeat)
+                print(f"{query!r:30} single process {single * 1000:9.2f} ms")
+                for workers in sorted(set(args.workers)):
+                    with ProcessPoolExecutor(max_workers=workers) as executor:
+                        # Warm up the pool so process start-up is not counted
+                        list(executor.map(abs, range(workers)))
+                        sharded, result = best_time(
+                            lambda: app.rank_fts_matches_sharded(c, fts_query, terms, args.top_k, executor, workers),
+                            args.repeat
+                        )
+                    assert result == expected, "sharded results differ from the single-process ranking"
+                    print(f"{'':30} {workers:3} workers    {sharded * 1000:9.2f} ms  "
+                          f"speed-up {single / sharded:5.2f}x")
+
+if __name__ == "__main__":
+    main()
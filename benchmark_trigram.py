@@ -0,0 +1,87 @@
+"""
+Benchmark: substring search over PDF text with the old full-scan query
+(SELECT ... FROM pdf_texts WHERE content LIKE '%term%') versus the trigram index
+behind /search_pdfs?mode=substring.
+
+Builds a synthetic corpus in a temporary directory, so it never touches pdf_cache.db.
+
+    python benchmark_trigram.py --docs 2000 --paragraphs 200
+"""
+import argparse
+import os
+import random
+import sqlite3
+import string
+import tempfile
+import time
+
+import app
+
+VOCABULARY = [
+    "silicone", "hydrogel", "methacrylate", "hydroxyethyl", "siloxane", "monomer", "crosslinker",
+    "absorber", "benzotriazole", "modulus", "oxygen", "permeability", "lens", "contact", "polymer",
+    "surfactant", "wettability", "tint", "initiator", "curing", "packaging", "saline", "solution"
+]
+
+def random_paragraph(rng):
+    words = rng.choices(VOCABULARY, k=rng.randint(8, 30))
+    # Part-number-like tokens give the substring queries something realistic to find
+    words.append("".join(rng.choices(string.ascii_uppercase, k=2)) + "-" + str(rng.randint(1000, 9999)))
+    return " ".join(words)
+
+def build_corpus(docs, paragraphs, seed):
+    rng = random.Random(seed)
+    app.init_pdf_cache_db()
+    batch = []
+    for doc in range(docs):
+        content = "\n".join(random_paragraph(rng) for _ in range(paragraphs))
+        batch.append((f"Author{doc}_{2000 + doc % 25}_Title{doc}_Publisher.pdf", content, "{}"))
+        if len(batch) >= 100:
+            app.batch_insert_pdfs(batch)
+            batch = []
+    if batch:
+        app.batch_insert_pdfs(batch)
+
+def best_time(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+def full_scan_first(term):
+    with sqlite3.connect("pdf_cache.db") as conn:
+        return conn.execute(
+            "SELECT pdf_name FROM pdf_texts WHERE content LIKE ? LIMIT 1", (f"%{term}%",)
+        ).fetchone() is not None
+
+def full_scan_count(term):
+    with sqlite3.connect("pdf_cache.db") as conn:
+        return conn.execute("SELECT COUNT(*) FROM pdf_texts WHERE content LIKE ?", (f"%{term}%",)).fetchone()[0]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=1000)
+    parser.add_argument("--paragraphs", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        start = time.perf_counter()
+        build_corpus(args.docs, args.paragraphs, args.seed)
+        print(f"Built {args.docs} docs x {args.paragraphs} paragraphs in {time.perf_counter() - start:.1f}s")
+
+        # A common fragment, a rare part-number fragment and a term that never occurs
+        for term in ("xyethyl", "QZ-12", "fluorosilicone"):
+            scan_first, _ = best_time(lambda: full_scan_first(term), args.repeat)
+            scan_count, count = best_time(lambda: full_scan_count(term), args.repeat)
+            trigram, result = best_time(lambda: app.search_pdfs_substring(term, 1, 10), args.repeat)
+            print(f"{term!r:18} full scan LIMIT 1 {scan_first * 1000:9.2f} ms | "
+                  f"full scan all ({count} docs) {scan_count * 1000:9.2f} ms | "
+                  f"trigram page 1 ({result['total']} paragraphs) {trigram * 1000:9.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def pdf_db(tmp_path, monkeypatch):
+    """
+    An empty pdf_cache.db in a temporary working directory. Every process-wide retrieval cache
+    is reset, so no test sees another test's corpus, and PDFs are stored one paragraph per line.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app, "CHUNK_MAX_CHARS", 0)
+    monkeypatch.setattr(app, "_tfidf_index", {"key": None, "arrays": None})
+    monkeypatch.setattr(app, "_mapped_corpus", {"key": None, "corpus": None})
+    monkeypatch.setattr(app, "_pdf_years", {"generation": None, "years": {}})
+    app.invalidate_retrieval_caches()
+    app.init_pdf_cache_db()
+    yield tmp_path
+    app.invalidate_retrieval_caches()
+
+
+@pytest.fixture
+def insert_pdfs(pdf_db):
+    """
+    Inserts (pdf_name, content) or (pdf_name, content, metadata) documents through batch_insert_pdfs.
+    """
+    def insert(*documents):
+        app.batch_insert_pdfs([
+            (document[0], document[1], json.dumps(document[2] if len(document) > 2 else {}))
+            for document in documents
+        ])
+    return insert
+
+
+@pytest.fixture
+def no_corpus_cache(monkeypatch):
+    # Forces retrieval through SQLite instead of the in-memory corpus snapshot
+    monkeypatch.setattr(app.corpus_cache, "max_bytes", 0)
@@ -0,0 +1,85 @@
+import pytest
+
+import app
+
+
+def test_parse_metadata_filters():
+    assert app.parse_metadata_filters(["year>=2018", "Publisher = 'Elsevier'", 'author="de Vries"']) == (
+        ("year", ">=", 2018), ("publisher", "=", "Elsevier"), ("author", "=", "de Vries"))
+    assert app.parse_metadata_filters(None) == ()
+
+
+@pytest.mark.parametrize("text", ["year>=soon", "pages=10", "author=", "title"])
+def test_parse_metadata_filters_rejects_invalid(text):
+    with pytest.raises(ValueError):
+        app.parse_metadata_filters([text])
+
+
+@pytest.fixture
+def library(insert_pdfs):
+    insert_pdfs(
+        ("Smith_2012_Lenses_Elsevier.pdf", "oxygen permeability of hydrogel lenses"),
+        ("Jones_2021_Polymers_Wiley.pdf", "oxygen transport in silicone polymers"),
+        ("Lee_2016_Coatings_Elsevier.pdf", "plasma coatings reduce oxygen uptake"),
+    )
+
+
+def pdf_names(results):
+    return sorted(result["pdf_name"] for result in results)
+
+
+@pytest.mark.parametrize("filters, expected", [
+    (["year>=2016"], ["Jones_2021_Polymers_Wiley.pdf", "Lee_2016_Coatings_Elsevier.pdf"]),
+    (["publisher=elsevier"], ["Lee_2016_Coatings_Elsevier.pdf", "Smith_2012_Lenses_Elsevier.pdf"]),
+    (["publisher=Elsevier", "year<2016"], ["Smith_2012_Lenses_Elsevier.pdf"]),
+    (["author!=JONES"], ["Lee_2016_Coatings_Elsevier.pdf", "Smith_2012_Lenses_Elsevier.pdf"]),
+    (["year>2030"], []),
+])
+def test_filters_apply_to_every_search_path(library, filters, expected):
+    assert pdf_names(app.search_pdfs_helper("oxygen", 10, filters=filters)) == expected
+    assert pdf_names(app.search_pdfs_helper("oxygen", 10, ranked=False, filters=filters)) == expected
+    parsed = app.parse_metadata_filters(filters)
+    assert pdf_names(app.search_pdfs_page("oxygen", filters=parsed)["results"]) == expected
+    assert pdf_names(app.search_pdfs_substring("xygen", filters=parsed)["results"]) == expected
+    assert pdf_names(app.scan_pdfs_helper("oxygen", 10, parsed)) == expected
+
+
+SHARED = "Silicone hydrogel lenses transmit oxygen through the polymer matrix to the cornea during wear."
+
+
+@pytest.fixture
+def revisions(insert_pdfs):
+    insert_pdfs(("Smith_2012_Lenses_Elsevier.pdf", SHARED + "\nFirst edition preface."),
+                ("Smith_2021_Lenses_Elsevier.pdf", "Second edition preface.\n" + SHARED))
+
+
+@pytest.mark.parametrize("filters, expected", [
+    (["year>=2020"], "Smith_2021_Lenses_Elsevier.pdf"),
+    (["year<2015"], "Smith_2012_Lenses_Elsevier.pdf"),
+    ([], "Smith_2021_Lenses_Elsevier.pdf"),
+])
+def test_filters_match_any_revision_of_a_deduplicated_paragraph(revisions, filters, expected):
+    parsed = app.parse_metadata_filters(filters)
+    results = [
+        app.search_pdfs_helper("cornea", 10, filters=filters),
+        app.search_pdfs_helper("cornea", 10, rerank=False, filters=filters),
+        app.search_pdfs_helper("cornea", 10, ranked=False, filters=filters),
+        app.search_pdfs_helper("cornea", 10, retriever="sharded", rerank=False, filters=filters),
+        app.search_pdfs_page("cornea", filters=parsed)["results"],
+        app.search_pdfs_substring("corne", filters=parsed)["results"],
+    ]
+    for paragraphs in results:
+        assert [result["pdf_name"] for result in paragraphs] == [expected]
+    citation = app.build_citation(expected, {})["citation"]
+    assert results[0][0]["source"] == citation
+    assert results[4][0]["citation"] == citation
+    assert results[4][0]["page_number"] == 1
+
+
+def test_unfiltered_paths_cite_the_newest_revision(revisions, monkeypatch):
+    app.build_corpus_file()
+    assert app.retrieve_pdf_paragraphs("cornea", retriever="bm25")[0]["pdf_name"] == "Smith_2021_Lenses_Elsevier.pdf"
+    monkeypatch.setattr(app.corpus_cache, "max_bytes", 0)
+    assert app.retrieve_pdf_paragraphs("cornea", retriever="bm25")[0]["pdf_name"] == "Smith_2021_Lenses_Elsevier.pdf"
+    app.build_tfidf_index()
+    assert app.retrieve_pdf_paragraphs("cornea", retriever="tfidf")[0]["pdf_name"] == "Smith_2021_Lenses_Elsevier.pdf"
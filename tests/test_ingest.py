@@ -0,0 +1,200 @@
+import sqlite3
+
+import pytest
+
+import app
+
+BODY = ("Silicone hydrogel lenses transmit oxygen through the polymer matrix to the cornea "
+        "during extended wear.")
+
+
+def document(lines):
+    return "\n".join(lines)
+
+
+def index_stats():
+    with sqlite3.connect("pdf_cache.db") as conn:
+        return dict(conn.execute("SELECT name, value FROM pdf_index_stats WHERE name != 'generation'"))
+
+
+# ---------------------
+# Chunking
+# ---------------------
+def sample_content():
+    blocks = []
+    for block in range(12):
+        lines = [f"Sentence {block}.{line} about lens care and storage solutions for wearers." for line in
+                 range(block % 5 + 1)]
+        blocks.append("\n".join(lines))
+        if block % 4 == 3:
+            blocks.append("RESULTS")
+    return "\n\n".join(blocks) + "\f\nLast page text."
+
+
+@pytest.mark.parametrize("max_chars, min_chars, overlap_chars", [(300, 100, 80), (1200, 400, 200), (120, 0, 0)])
+def test_chunks_respect_bounds_and_cover_every_line(max_chars, min_chars, overlap_chars):
+    content = sample_content()
+    lines = [record[1] for record in app.build_paragraph_records(content)]
+    chunks = app.build_chunk_records(content, max_chars, min_chars, overlap_chars)
+    assert [chunk[0] for chunk in chunks] == list(range(len(chunks)))
+    covered = set()
+    for previous, chunk in zip([None] + chunks, chunks):
+        _, text, char_start, char_end, page_number = chunk
+        assert len(text) <= max_chars
+        chunk_lines = text.split("\n")
+        assert content[char_start:].startswith(chunk_lines[0])
+        assert content[:char_end].endswith(chunk_lines[-1])
+        covered.update(chunk_lines)
+        if previous is not None:
+            overlap = [line for line in previous[1].split("\n") if line in chunk_lines]
+            assert sum(len(line) + 1 for line in overlap) <= overlap_chars
+    assert covered == set(lines)
+    assert chunks[-1][4] == 2
+
+
+def test_chunking_disabled_keeps_one_unit_per_line():
+    content = sample_content()
+    assert app.build_chunk_records(content, max_chars=0) == app.build_paragraph_records(content)
+
+
+# ---------------------
+# Near-duplicate collapse
+# ---------------------
+def test_near_duplicates_are_indexed_once(insert_pdfs):
+    insert_pdfs(("Smith_2012_Lenses_Elsevier.pdf", document([BODY, "Tint curing happens before packaging."])),
+                ("Smith_2021_Lenses_Elsevier.pdf", document([BODY.upper(), "Sterile packaging of daily lenses."])))
+    assert len(app.retrieve_pdf_paragraphs("cornea", 10, retriever="bm25")) == 1
+    assert index_stats() == {"paragraph_count": 3, "token_count": index_stats()["token_count"], "duplicate_count": 1}
+
+
+def test_deleting_the_canonical_copy_promotes_a_duplicate(insert_pdfs, no_corpus_cache):
+    insert_pdfs(("Smith_2012_Lenses_Elsevier.pdf", document([BODY, "Tint curing happens before packaging."])),
+                ("Smith_2021_Lenses_Elsevier.pdf", document([BODY, "Sterile packaging of daily lenses."])),
+                ("Smith_2022_Lenses_Elsevier.pdf", BODY))
+    token_count = index_stats()["token_count"]
+    app.remove_ingested_blobs(["Smith_2012_Lenses_Elsevier.pdf"])
+
+    results = app.retrieve_pdf_paragraphs("cornea", 10, retriever="bm25")
+    assert len(results) == 1
+    assert results[0]["pdf_name"] != "Smith_2012_Lenses_Elsevier.pdf"
+    assert index_stats() == {"paragraph_count": 2, "duplicate_count": 1,
+                             "token_count": token_count - len(app.tokenize("Tint curing happens before packaging."))}
+    with sqlite3.connect("pdf_cache.db") as conn:
+        canonical = conn.execute("SELECT id FROM pdf_paragraphs WHERE canonical_id IS NULL AND text = ?",
+                                 (BODY,)).fetchall()
+        assert len(canonical) == 1
+        assert conn.execute("SELECT canonical_id FROM pdf_paragraphs WHERE text = ? AND canonical_id IS NOT NULL",
+                            (BODY,)).fetchall() == canonical
+        assert conn.execute("SELECT COUNT(*) FROM pdf_paragraph_lsh WHERE paragraph_id = ?",
+                            canonical[0]).fetchone()[0] == app.MINHASH_BANDS
+
+    app.remove_ingested_blobs(["Smith_2021_Lenses_Elsevier.pdf", "Smith_2022_Lenses_Elsevier.pdf"])
+    assert app.retrieve_pdf_paragraphs("cornea", 10, retriever="bm25") == []
+    assert index_stats() == {"paragraph_count": 0, "token_count": 0, "duplicate_count": 0}
+
+
+def test_reingesting_a_pdf_replaces_its_rows(insert_pdfs):
+    insert_pdfs(("Smith_2012_Lenses_Elsevier.pdf", "Old wording about hydrogel lenses"))
+    insert_pdfs(("Smith_2012_Lenses_Elsevier.pdf", "New wording about silicone lenses"))
+    assert app.retrieve_pdf_paragraphs("hydrogel", retriever="bm25") == []
+    assert len(app.retrieve_pdf_paragraphs("silicone", retriever="bm25")) == 1
+
+
+# ---------------------
+# Ingestion pipeline
+# ---------------------
+@pytest.fixture
+def fake_container(pdf_db, monkeypatch):
+    """
+    Serves blob names as PDF bytes and "extracts" them back to text. Names containing
+    download-error, no-download, extract-error or no-text fail in the matching stage.
+    """
+    def download_blob(name):
+        if "download-error" in name:
+            raise IOError("connection reset")
+        return None if "no-download" in name else name.encode()
+
+    def extract(pdf_bytes, pdf_name=None):
+        if "extract-error" in pdf_name:
+            raise RuntimeError("corrupt PDF")
+        return None if "no-text" in pdf_name else (f"Text of {pdf_name} about hydrogel lenses", {})
+
+    monkeypatch.setattr(app, "download_blob", download_blob)
+    monkeypatch.setattr(app, "extract_text_and_metadata_hybrid", extract)
+    monkeypatch.setattr(app, "INGEST_STAGE_WORKERS", {"download": 2, "extract": 2, "chunk": 1, "insert": 1})
+
+
+def blob(name, etag="1"):
+    return (name, etag, 100, "2024-01-01T00:00:00")
+
+
+def stored_names():
+    with sqlite3.connect("pdf_cache.db") as conn:
+        return sorted(row[0] for row in conn.execute("SELECT pdf_name FROM pdf_texts"))
+
+
+def test_pipeline_stores_successes_and_counts_failures(fake_container):
+    blobs = [blob(name) for name in ("a.pdf", "no-download.pdf", "download-error.pdf", "b.pdf",
+                                     "extract-error.pdf", "no-text.pdf", "c.pdf")]
+    summary = app.run_ingest_pipeline(blobs, queue_size=1, insert_batch=2)
+    stages = summary["stages"]
+    assert summary["listing_complete"]
+    assert stages["download"]["processed"] == 5 and stages["download"]["failed"] == 2
+    assert stages["extract"]["processed"] == 3 and stages["extract"]["failed"] == 2
+    assert stages["insert"]["processed"] == 3 and stages["insert"]["failed"] == 0
+    assert stored_names() == ["a.pdf", "b.pdf", "c.pdf"]
+    # Failed blobs stay out of the manifest, so the next run retries them
+    assert sorted(app.load_ingest_manifest()) == ["a.pdf", "b.pdf", "c.pdf"]
+
+
+def test_pipeline_skips_unchanged_blobs_and_honours_limit(fake_container):
+    app.run_ingest_pipeline([blob("a.pdf"), blob("b.pdf")])
+    listed = set()
+    summary = app.run_ingest_pipeline([blob("a.pdf"), blob("b.pdf", "2"), blob("c.pdf"), blob("d.pdf")],
+                                      app.load_ingest_manifest(), limit=2, listed=listed)
+    assert listed == {"a.pdf", "b.pdf", "c.pdf", "d.pdf"}
+    assert summary["stages"]["insert"]["processed"] == 2
+    assert app.load_ingest_manifest()["b.pdf"][0] == "2"
+    assert stored_names() == ["a.pdf", "b.pdf", "c.pdf"]
+
+
+def test_pipeline_survives_insert_failures(fake_container, monkeypatch):
+    def insert(batch):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(app, "insert_ingested_blobs", insert)
+    summary = app.run_ingest_pipeline([blob(f"{i}.pdf") for i in range(5)], queue_size=1)
+    assert summary["stages"]["insert"]["failed"] == 5
+    assert stored_names() == []
+
+
+def test_failed_listing_never_removes_ingested_pdfs(fake_container, monkeypatch):
+    app.run_ingest_pipeline([blob("a.pdf"), blob("b.pdf")])
+
+    def partial_listing():
+        yield blob("a.pdf")
+        raise IOError("listing interrupted")
+    monkeypatch.setattr(app, "iter_blob_properties", partial_listing)
+    app.preprocess_pdfs_to_db()
+    assert stored_names() == ["a.pdf", "b.pdf"]
+
+    monkeypatch.setattr(app, "iter_blob_properties", lambda: iter([blob("a.pdf")]))
+    app.preprocess_pdfs_to_db()
+    assert stored_names() == ["a.pdf"]
+    assert sorted(app.load_ingest_manifest()) == ["a.pdf"]
+
+
+def test_init_rebuilds_databases_from_an_older_schema(pdf_db):
+    with sqlite3.connect("pdf_cache.db") as conn:
+        conn.execute("INSERT INTO pdf_texts (pdf_name, content, metadata) VALUES (?, ?, ?)",
+                     ("Smith_2012_Lenses_Elsevier.pdf", "Hydrogel lenses absorb water", "{}"))
+        conn.execute("PRAGMA user_version = 0")
+    assert app.retrieve_pdf_paragraphs("hydrogel", retriever="bm25") == []
+
+    app.init_pdf_cache_db()
+    results = app.retrieve_pdf_paragraphs("hydrogel", retriever="bm25")
+    assert [result["source"] for result in results] == ["Smith (2012). Lenses. Elsevier."]
+    with sqlite3.connect("pdf_cache.db") as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == app.PDF_CACHE_SCHEMA_VERSION
+        generation = app.read_corpus_generation()
+    app.init_pdf_cache_db()
+    assert app.read_corpus_generation() == generation
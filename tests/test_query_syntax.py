@@ -0,0 +1,102 @@
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize("query, constraints, terms", [
+    ("silicone hydrogel", [], ["silicone", "hydrogel"]),
+    ('"silicone hydrogel" lens', ['"silicone hydrogel"'], ["silicone", "hydrogel", "lens"]),
+    ("tint NEAR/3 curing", ['NEAR("tint" "curing", 3)'], ["tint", "curing"]),
+    ("tint NEAR curing", [f'NEAR("tint" "curing", {app.NEAR_DEFAULT_DISTANCE})'], ["tint", "curing"]),
+    ('a NEAR/2 "b c" NEAR/5 d', ['NEAR("a" "b c" "d", 5)'], ["a", "b", "c", "d"]),
+    ("NEAR/2 oxygen", [], ["oxygen"]),
+    ('""  ', [], []),
+    ("O2-permeability", [], ["o2", "permeability"]),
+])
+def test_parse_search_query(query, constraints, terms):
+    assert app.parse_search_query(query) == (constraints, terms)
+
+
+def test_build_fts_query_quotes_words_and_requires_constraints():
+    assert app.build_fts_query("lens AND oxygen") == '"lens" OR "and" OR "oxygen"'
+    assert app.build_fts_query('"contact lens" NEAR/4 oxygen') == 'NEAR("contact lens" "oxygen", 4)'
+    assert app.build_fts_query('"a b" "c d"') == '"a b" AND "c d"'
+    assert app.build_fts_query("   ") == ""
+
+
+@pytest.fixture
+def phrases(insert_pdfs):
+    insert_pdfs(("Smith_2012_Lenses_Elsevier.pdf", "\n".join([
+        "silicone hydrogel lenses improve oxygen flow",
+        "hydrogel made with silicone additives",
+        "tint applied before the curing step",
+        "tint applied to the lens long before any thermal curing step",
+    ])))
+
+
+def paragraphs(query):
+    return sorted(result["paragraph"] for result in app.retrieve_pdf_paragraphs(query, 10, retriever="bm25"))
+
+
+def test_phrase_requires_adjacent_words(phrases):
+    assert paragraphs('"silicone hydrogel"') == ["silicone hydrogel lenses improve oxygen flow"]
+    assert len(paragraphs("silicone hydrogel")) == 2
+
+
+def test_near_respects_distance(phrases):
+    assert paragraphs("tint NEAR/3 curing") == ["tint applied before the curing step"]
+    assert len(paragraphs("tint NEAR/10 curing")) == 2
+
+
+def test_search_page_highlights_query_words_only(phrases):
+    page = app.search_pdfs_page("tint NEAR/3 curing")
+    assert page["total"] == 1
+    result = page["results"][0]
+    assert [result["snippet"][start:end] for start, end in result["highlights"]] == ["tint", "curing"]
+
+
+@pytest.mark.parametrize("whole_words, paragraph, expected", [
+    (False, "Soft lenses", {"lens", "lenses", "soft"}),
+    (True, "Soft lenses", {"lenses", "soft"}),
+    (True, "A lens, two lenses", {"lens", "lenses"}),
+    (True, "lensmaker", set()),
+    (True, "lens_case", {"lens"}),
+    (False, "no match here", set()),
+])
+def test_matched_terms(whole_words, paragraph, expected):
+    matcher = app.QueryMatcher(["lens", "LENSES", "soft"], whole_words=whole_words)
+    assert matcher.matched_terms(paragraph) == expected
+    assert matcher.matches(paragraph) == bool(expected)
+
+
+def test_matcher_drops_stopwords():
+    assert app.QueryMatcher(["the", "lens", "of"], drop_stopwords=True).terms == ["lens"]
+
+
+def test_rerank_coverage_counts_whole_query_words():
+    matcher = app.QueryMatcher(["lens", "oxygen"], whole_words=True)
+    assert app.rerank_features("lenses need oxygen", matcher) == {"coverage": 0.5, "proximity": 0.0}
+    assert app.rerank_features("lens and oxygen", matcher) == {"coverage": 1.0, "proximity": 0.5}
+
+
+def scanned(query):
+    return sorted(result["paragraph"] for result in app.scan_pdfs_helper(query, 10))
+
+
+def test_scan_reads_phrases_and_near_like_the_index(phrases):
+    assert scanned('"silicone hydrogel"') == ["silicone hydrogel lenses improve oxygen flow"]
+    assert scanned('"Silicone-Hydrogel"') == ["silicone hydrogel lenses improve oxygen flow"]
+    assert scanned("tint NEAR/3 curing") == ["tint applied before the curing step",
+                                             "tint applied to the lens long before any thermal curing step"]
+    assert scanned("oxygen NEAR/2 curing") == []
+    assert len(scanned("silicone hydrogel")) == 2
+
+
+def test_scan_bloom_probes_follow_parsed_query(insert_pdfs):
+    insert_pdfs(("Smith_2012_Lenses_Elsevier.pdf", "silicone hydrogel lenses"),
+                ("Jones_2021_Polymers_Wiley.pdf", "silicone polymers"))
+    stats = app.bloom_scan_stats.stats()
+    assert [result["pdf_name"] for result in app.scan_pdfs_helper('"silicone hydrogel"')] == [
+        "Smith_2012_Lenses_Elsevier.pdf"]
+    assert app.bloom_scan_stats.stats()["documents_skipped"] == stats["documents_skipped"] + 1
+    assert app.bloom_query_probes("NEAR/2 ab") is None
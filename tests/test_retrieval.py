@@ -0,0 +1,171 @@
+import random
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+import app
+
+WORDS = ("lens hydrogel silicone oxygen cornea tint curing polymer water contact wear comfort "
+         "modulus coating plasma monomer surface solution storage packaging sterile").split()
+QUERIES = ["hydrogel oxygen", "silicone", "cornea comfort wear", "plasma coating surface", "tint", "absent"]
+
+
+@pytest.fixture
+def corpus(insert_pdfs):
+    rng = random.Random(7)
+    documents = []
+    for doc_index in range(6):
+        lines = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 14))) + f" doc{doc_index}x{line}"
+                 for line in range(12)]
+        documents.append((f"Author{doc_index}_{2000 + doc_index}_Title_Publisher.pdf", "\n".join(lines)))
+    insert_pdfs(*documents)
+
+
+def brute_force_bm25(query, k):
+    with sqlite3.connect("pdf_cache.db") as conn:
+        rows = conn.execute("SELECT id, text FROM pdf_paragraphs WHERE canonical_id IS NULL ORDER BY id").fetchall()
+    tokens = {paragraph_id: app.tokenize(text) for paragraph_id, text in rows}
+    terms = list(dict.fromkeys(app.tokenize(query)))
+    doc_freqs = {term: sum(term in paragraph for paragraph in tokens.values()) for term in terms}
+    doc_freqs = {term: doc_freq for term, doc_freq in doc_freqs.items() if doc_freq}
+    avg_length = sum(map(len, tokens.values())) / len(tokens)
+    scored = []
+    for paragraph_id, text in rows:
+        term_counts = {term: tokens[paragraph_id].count(term) for term in doc_freqs}
+        if any(term_counts.values()):
+            score = app.bm25_score(term_counts, len(tokens[paragraph_id]), doc_freqs, len(rows), avg_length)
+            scored.append((-score, paragraph_id, text))
+    return [(text, round(-negative, 4)) for negative, _, text in sorted(scored)[:k]]
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_bm25_top_k_matches_brute_force(corpus, no_corpus_cache, query):
+    results = app.retrieve_pdf_paragraphs(query, max_paragraphs=5, retriever="bm25")
+    assert [(result["paragraph"], result["score"]) for result in results] == brute_force_bm25(query, 5)
+
+
+def test_bm25_scores_are_descending(corpus, no_corpus_cache):
+    scores = [result["score"] for result in app.retrieve_pdf_paragraphs("hydrogel oxygen", 20, retriever="bm25")]
+    assert len(scores) == 20
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_push_top_k_keeps_best_and_prefers_earlier_ties():
+    heap = []
+    for seq, score in enumerate([1.0, 3.0, 2.0, 3.0, 0.5, 2.0]):
+        app.push_top_k(heap, 3, score, seq, f"item{seq}")
+    assert [item for _, _, item in sorted(heap, reverse=True)] == ["item1", "item3", "item2"]
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_corpus_cache_matches_database(corpus, monkeypatch, query):
+    cached = app.retrieve_pdf_paragraphs(query, max_paragraphs=8, retriever="bm25")
+    cached_unranked = app.retrieve_pdf_paragraphs(query, max_paragraphs=8, ranked=False)
+    assert app.corpus_cache.get() is not None
+    monkeypatch.setattr(app.corpus_cache, "max_bytes", 0)
+    assert app.retrieve_pdf_paragraphs(query, max_paragraphs=8, retriever="bm25") == cached
+    assert app.retrieve_pdf_paragraphs(query, max_paragraphs=8, ranked=False) == cached_unranked
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_corpus_file_matches_database(corpus, no_corpus_cache, query):
+    from_db = app.retrieve_pdf_paragraphs(query, max_paragraphs=8, retriever="bm25")
+    app.build_corpus_file()
+    assert app.mapped_corpus() is not None
+    assert app.retrieve_pdf_paragraphs(query, max_paragraphs=8, retriever="bm25") == from_db
+
+
+@pytest.mark.parametrize("max_df", [app.BATCH_UNION_MAX_DF, 1.0])
+def test_batch_matches_single_queries(corpus, no_corpus_cache, monkeypatch, max_df):
+    monkeypatch.setattr(app, "BATCH_UNION_MAX_DF", max_df)
+    queries = QUERIES + ["Silicone", '"contact lens"']
+    single = [app.retrieve_pdf_paragraphs(query, 5, retriever="bm25") for query in queries]
+    assert app.search_pdfs_batch_helper(queries, 5, rerank=False) == single
+
+
+def test_sharded_matches_in_process(corpus):
+    with sqlite3.connect("pdf_cache.db") as conn, ProcessPoolExecutor(max_workers=2) as executor:
+        c = conn.cursor()
+        for query in QUERIES:
+            fts_query = app.build_fts_query(query)
+            _, terms = app.parse_search_query(query)
+            expected = app.rank_fts_matches(c, fts_query, terms, 7)
+            assert app.rank_fts_matches_sharded(c, fts_query, terms, 7, executor=executor, shards=3) == expected
+
+
+def test_query_cache_serves_normalized_repeats(insert_pdfs):
+    insert_pdfs(("Smith_2012_Lenses_Elsevier.pdf", "Hydrogel lenses absorb water"))
+    first = app.search_pdfs_helper("Hydrogel LENSES", rerank=False)
+    hits = app.query_result_cache.hits
+    first[0]["paragraph"] = "changed by the caller"
+    again = app.search_pdfs_helper("lenses hydrogel", rerank=False)
+    assert app.query_result_cache.hits == hits + 1
+    assert again[0]["paragraph"] == "Hydrogel lenses absorb water"
+
+
+def test_insert_invalidates_query_and_corpus_caches(insert_pdfs):
+    insert_pdfs(("Smith_2012_Lenses_Elsevier.pdf", "Hydrogel lenses absorb water"))
+    assert len(app.search_pdfs_helper("hydrogel", rerank=False)) == 1
+    assert app.corpus_cache.get() is not None
+    insert_pdfs(("Jones_2020_Polymers_Wiley.pdf", "Silicone hydrogel polymers"))
+    assert {result["pdf_name"] for result in app.search_pdfs_helper("hydrogel", rerank=False)} == {
+        "Smith_2012_Lenses_Elsevier.pdf", "Jones_2020_Polymers_Wiley.pdf"}
+
+
+def test_stale_tfidf_index_is_not_used(insert_pdfs):
+    insert_pdfs(("Smith_2012_Lenses_Elsevier.pdf", "Hydrogel lenses absorb water"))
+    app.build_tfidf_index()
+    assert len(app.retrieve_pdf_paragraphs("hydrogel", retriever="tfidf")) == 1
+    insert_pdfs(("Jones_2020_Polymers_Wiley.pdf", "Silicone hydrogel polymers"))
+    assert len(app.retrieve_pdf_paragraphs("hydrogel", retriever="tfidf")) == 2
+
+
+def test_query_result_cache_evicts_and_expires():
+    cache = app.QueryResultCache(max_entries=2, ttl=60)
+    cache.put("a", 1, ["a"])
+    cache.put("b", 1, ["b"])
+    cache.get("a", 1)
+    cache.put("c", 1, ["c"])
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 1) == ["a"]
+    assert cache.get("a", 2) is None
+    expired = app.QueryResultCache(max_entries=2, ttl=-1)
+    expired.put("a", 1, ["a"])
+    assert expired.get("a", 1) is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_fallback_answers_are_not_cached(insert_pdfs, monkeypatch):
+    insert_pdfs(("Smith_2012_Lenses_Elsevier.pdf", "Hydrogel lenses absorb water"))
+    # No TF-IDF index yet: answered by BM25, but not cached under the TF-IDF key
+    assert len(app.search_pdfs_helper("hydrogel", retriever="tfidf", rerank=False)) == 1
+    assert app.query_result_cache.stats()["entries"] == 0
+    app.build_tfidf_index()
+    assert len(app.search_pdfs_helper("hydrogel", retriever="tfidf", rerank=False)) == 1
+    assert app.query_result_cache.stats()["entries"] == 1
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("disk I/O error")
+    with monkeypatch.context() as patch:
+        patch.setattr(app, "rank_fts_matches", broken)
+        patch.setattr(app.corpus_cache, "max_bytes", 0)
+        assert app.search_pdfs_helper("water") == []
+        assert app.search_pdfs_batch_helper(['"absorb water"']) == [[]]
+        assert app.query_result_cache.stats()["entries"] == 1
+    assert len(app.search_pdfs_helper("water")) == 1
+
+
+def test_rerank_scores_stay_ordered_when_the_budget_runs_out(pdf_db, monkeypatch):
+    # Later candidates match the query better, so reranking them would outscore the first ones
+    candidates = [{"paragraph": f"{'hydrogel oxygen lens' if i % 2 else 'packaging'} note {i}",
+                   "pdf_name": "Smith_2012_Lenses_Elsevier.pdf", "score": 10.0 - i} for i in range(8)]
+    ticks = iter(range(1000))
+    monkeypatch.setattr(app.time, "perf_counter", lambda: next(ticks) / 1000)
+    results, reranked = app.rerank_paragraphs("hydrogel oxygen lens", candidates, 6, time_budget_ms=3.5)
+    assert 0 < reranked < 6
+    scores = [result["score"] for result in results]
+    assert scores == sorted(scores, reverse=True)
+    assert [result["retrieval_score"] for result in results[reranked:]] == [
+        candidate["score"] for candidate in candidates[reranked:6]]
+    assert results[-1]["score"] == round(app.RERANK_WEIGHTS["retrieval"] * candidates[5]["score"] / 10.0, 4)